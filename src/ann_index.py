@@ -0,0 +1,240 @@
+from __future__ import division
+
+import json
+import logging
+import os
+import time
+from threading import Lock, Thread
+import numpy as np
+import cv2
+
+import image_description
+from descriptor_index import DescriptorIndex
+
+INDEX_FILE = "flann.index"
+INDEX_INFO_FILE = "flann.json"
+
+# Number of nearest neighbours we look for in the whole database for every
+# feature of the scene.
+NEIGHBOURS = 8
+
+
+#
+# This class is a DescriptorIndex that uses FLANN to find approximate nearest
+# neighbours in the whole database instead of matching every stored feature
+# against the scene.
+#
+# The direction of the search is reversed compared to DescriptorIndex: we look
+# for the nearest stored features of every feature of the scene, then apply
+# the ratio test between the two nearest features that belong to the same
+# item. If an item appears only once among the neighbours, the distance of
+# the farthest neighbour is used in place of its second best distance, which
+# is a lower bound of the real one. If it is the farthest neighbour itself,
+# there is no such bound and the match is rejected.
+#
+# The search runs over the whole database, the histogram shortlist only
+# filters the matches afterwards.
+#
+# The FLANN index covers the features of the items that existed when it was
+# built. Items registered afterwards are matched by brute force until enough
+# of them have piled up, at which point the index is rebuilt in a background
+# thread.
+# KD-tree indices are saved next to the database and loaded at startup. FLANN
+# can't serialize LSH indices, so these are rebuilt in the background when
+# the database is loaded, which is cheap as LSH only hashes the features.
+#
+class AnnIndex(DescriptorIndex):
+    def __init__(self, root, items, features, shortlist, rebuild_threshold,
+                 counts=None, histograms=None):
+        DescriptorIndex.__init__(self, items, features, shortlist,
+                                 counts=counts, histograms=histograms)
+        self.logger = logging.getLogger(__name__)
+        self.root = root
+        self.rebuild_threshold = rebuild_threshold
+        self.lock = Lock()
+        self.rebuild_thread = None
+
+        # The FLANN index, the features and the number of items it covers.
+        # These are replaced altogether when a rebuild completes. We keep a
+        # reference to the features as FLANN doesn't copy them.
+        self.state = (None, None, 0)
+
+        self._load()
+
+        (_, _, indexed_items) = self.state
+        if indexed_items < len(self.items):
+            self._rebuild_async()
+
+    def add(self, item, features=None):
+        DescriptorIndex.add(self, item, features)
+
+        (_, _, indexed_items) = self.state
+        if len(self.items) - indexed_items >= self.rebuild_threshold:
+            self._rebuild_async()
+
+    # The search runs over the whole database anyway, so we don't restrict it
+    # to the candidates, but only the matches with candidates are kept.
+    def _good_matches(self, target, candidates):
+        (flann, indexed_features, _) = self.state
+        indexed_rows = len(indexed_features) if flann is not None else 0
+        scene = target.features
+        empty = np.zeros(0, dtype=np.intp)
+        if len(scene) == 0:
+            return (empty, empty, empty)
+
+        # Nearest neighbours among the indexed rows and among the rows that
+        # were added since the index was built.
+        neighbours = []
+        if flann is not None:
+            k = min(NEIGHBOURS, indexed_rows)
+            (indices, distances) = flann.knnSearch(scene, k, params={})
+            distances = distances.astype(np.float64)
+            if image_description.feature_norm == cv2.NORM_L2:
+                # KD-tree indices return squared euclidean distances.
+                distances = np.sqrt(distances)
+            neighbours.append((indices.astype(np.intp), distances))
+
+        if len(self.features) > indexed_rows:
+            neighbours.append(self._brute_force(scene,
+                                                self.features[indexed_rows:],
+                                                indexed_rows))
+
+        indices = np.concatenate([n[0] for n in neighbours], axis=1)
+        distances = np.concatenate([n[1] for n in neighbours], axis=1)
+        distances[indices < 0] = np.inf
+
+        # Keep the nearest neighbours, sorted by distance.
+        order = np.argsort(distances, axis=1)[:, :NEIGHBOURS]
+        rows = np.arange(len(scene))[:, np.newaxis]
+        indices = indices[rows, order]
+        distances = distances[rows, order]
+        valid = np.isfinite(distances)
+        owners = np.where(valid, self.item_ids[np.maximum(indices, 0)], -1)
+
+        # Distance that we use when an item has a single neighbour: the
+        # distance of the farthest valid neighbour. Neighbours may be missing,
+        # e.g. if the database has fewer than NEIGHBOURS features or LSH
+        # doesn't find enough of them.
+        bound = np.where(valid, distances, -np.inf).max(axis=1)
+
+        shortlisted = np.zeros(len(self.items) + 1, dtype=bool)
+        shortlisted[candidates] = True
+        # Invalid neighbours belong to item -1, i.e. the last, unused entry.
+        owners_shortlisted = shortlisted[owners]
+
+        # For every column, only keep the first (i.e. nearest) neighbour of
+        # every item, and look for the second nearest one in the next columns.
+        good_matches = []
+        for column in range(distances.shape[1]):
+            first = valid[:, column].copy()
+            for previous in range(column):
+                first &= owners[:, previous] != owners[:, column]
+
+            second = bound.copy()
+            for following in range(distances.shape[1] - 1, column, -1):
+                second = np.where(owners[:, following] == owners[:, column],
+                                  distances[:, following], second)
+
+            good = first & owners_shortlisted[:, column] & \
+                (distances[:, column] <
+                 image_description.ratio_test_k * second)
+            good_matches.append((indices[good, column], np.flatnonzero(good),
+                                 distances[good, column]))
+
+        return tuple(np.concatenate(arrays) for arrays in zip(*good_matches))
+
+    @staticmethod
+    def _brute_force(scene, features, offset):
+        k = min(NEIGHBOURS, len(features))
+        indices = np.full((len(scene), k), -1, dtype=np.intp)
+        distances = np.full((len(scene), k), np.inf)
+
+        matcher = cv2.BFMatcher(image_description.feature_norm)
+        for row, matches in enumerate(matcher.knnMatch(scene, features, k=k)):
+            for column, match in enumerate(matches):
+                indices[row, column] = match.trainIdx + offset
+                distances[row, column] = match.distance
+
+        return (indices, distances)
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    # Load the index that was saved next to the database, if it is still
+    # compatible with the current features and parameters.
+    def _load(self):
+        params = image_description.flann_params
+        if params['algorithm'] != image_description.FLANN_INDEX_KDTREE or \
+                not self.items or \
+                not os.path.isfile(self._path(INDEX_INFO_FILE)):
+            return
+
+        with open(self._path(INDEX_INFO_FILE)) as f:
+            info = json.load(f)
+
+        if info['params'] != params or info['rows'] > len(self.features) or \
+                info['items'] > len(self.items):
+            self.logger.info("Saved FLANN index is outdated, ignoring it.")
+            return
+
+        start = time.time()
+        data = self.features[:info['rows']]
+        flann = cv2.flann_Index()
+        if not flann.load(data, self._path(INDEX_FILE)):
+            self.logger.warning("Can't load saved FLANN index.")
+            return
+
+        self.state = (flann, data, info['items'])
+        self.logger.debug("Loaded FLANN index over %s features in %ss",
+                          info['rows'], time.time() - start)
+
+    def _save(self, flann, rows, items):
+        params = image_description.flann_params
+        if params['algorithm'] != image_description.FLANN_INDEX_KDTREE:
+            return
+
+        # Remove the description of the previous index first and write the new
+        # one last, so that we never load an index with the wrong description.
+        if os.path.isfile(self._path(INDEX_INFO_FILE)):
+            os.remove(self._path(INDEX_INFO_FILE))
+
+        flann.save(self._path(INDEX_FILE) + ".tmp")
+        os.rename(self._path(INDEX_FILE) + ".tmp", self._path(INDEX_FILE))
+
+        with open(self._path(INDEX_INFO_FILE) + ".tmp", "w") as f:
+            json.dump({'params': params, 'rows': rows, 'items': items}, f)
+        os.rename(self._path(INDEX_INFO_FILE) + ".tmp",
+                  self._path(INDEX_INFO_FILE))
+
+    # Rebuild the index over all the current features in a background thread.
+    # Matching keeps using the previous index until the new one is ready.
+    def _rebuild_async(self):
+        with self.lock:
+            if self.rebuild_thread is not None:
+                return
+            self.rebuild_thread = Thread(name="flann-rebuild-thread",
+                                         target=self._rebuild,
+                                         args=(self.features,
+                                               len(self.items)))
+            self.rebuild_thread.daemon = True
+            self.rebuild_thread.start()
+
+    def _rebuild(self, features, items):
+        start = time.time()
+        flann = cv2.flann_Index(features, image_description.flann_params)
+
+        try:
+            self._save(flann, len(features), items)
+        except (IOError, OSError, cv2.error):
+            self.logger.exception("Can't save FLANN index.")
+
+        with self.lock:
+            self.state = (flann, features, items)
+            self.rebuild_thread = None
+
+        self.logger.debug("Built FLANN index over %s features in %ss",
+                          len(features), time.time() - start)
+
+        # More items may have been added while we were busy.
+        if len(self.items) - items >= self.rebuild_threshold:
+            self._rebuild_async()
@@ -1,18 +1,30 @@
 from __future__ import division, print_function
 
+import logging
 import math
 import time
 from array import array
-from threading import Thread
-import os
+from collections import deque
+from threading import Condition, Event, Thread
+import numpy as np
 import alsaaudio
 
+import instrumentation
+
 ALSA_SPEAKER = "plug:default"     # ALSA device identifier
 ALSA_MICROPHONE = "plug:default"  # ALSA device identifier
 BYTES_PER_SAMPLE = 2
 FORMAT = alsaaudio.PCM_FORMAT_S16_LE  # We use signed 16-bit samples
 SAMPLES_PER_SECOND = 16000            # at 16000 samples per second
 
+# The microphone is read in chunks of this many seconds.
+CHUNK_DURATION = 1 / 16
+CHUNK_SIZE = int(SAMPLES_PER_SECOND * CHUNK_DURATION)
+
+# An armed microphone is considered broken if it doesn't deliver a chunk for
+# this many seconds.
+READ_TIMEOUT = 2
+
 # Adjust this value as needed depending on mic sensitivity.
 # For a high-quality USB mic, 150 is a good value.
 # For a cheap USB headset, 3000 is better.
@@ -24,72 +36,282 @@ DEFAULT_SILENCE_THRESHOLD = 1000
 # an amplitude that starts high and drops to zero. This does not actually
 # play a sound. It just returns an array that can be passed to audio.play()
 def makebeep(frequency, duration):
-    # Generate the waveform for this beep
-    samples = array('h')
-    numsamples = int(SAMPLES_PER_SECOND * duration)
-    samples_per_cycle = SAMPLES_PER_SECOND / frequency
-    angle_per_sample = 2 * math.pi / samples_per_cycle
-    phase = 0.0
-    for i in range(0, numsamples):
-        factor = 1 - (i / numsamples)
-        samples.append(int(factor * 32000 * math.sin(phase)))
-        phase = (phase + angle_per_sample) % (2*math.pi)
+    return array('h', _synthesize(frequency, duration).tobytes())
 
+
+# Returns the samples of a beep, as makebeep(), but cached: tones are
+# synthesized on first use only. The returned array must not be modified.
+def tone(frequency, duration):
+    key = (frequency, duration)
+    samples = _tones.get(key)
+    if samples is None:
+        samples = _tones[key] = _synthesize(frequency, duration)
     return samples
 
-# Play the specified audio samples though the speakers.
-# This function expects and array or bytes object like those returned
-# by the makebeep() and record() functions.
-def _play(samples):
-    if len(samples) == 0:
-        return
-    speaker = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, card=ALSA_SPEAKER)
-    speaker.setchannels(1)
-    speaker.setrate(SAMPLES_PER_SECOND)
-    speaker.setformat(FORMAT)
-    speaker.setperiodsize(len(samples)//BYTES_PER_SAMPLE)
-    speaker.write(samples)
-
-def play(samples):
-    # the _play() function above only blocks until all the
-    # samples are buffered by the kernel, so it may return
-    # before the sound has finished playing.
-    # We want our function to block until the sound is done
-    start = time.time()
-    _play(samples)
-    end = time.time()
-    duration = len(samples)/(BYTES_PER_SAMPLE * SAMPLES_PER_SECOND)
-    elapsed = end - start
-    if duration > elapsed:
-        time.sleep(duration - elapsed)
-
-# Play the sound using a thread so we can return right away
-def playAsync(samples):
-    Thread(target=lambda: _play(samples)).start()
-
-def playfile(filename):
-    try:
-        filesize = os.path.getsize(filename)
-        with open(filename, 'rb') as f:
-            speaker = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, card=ALSA_SPEAKER)
-            speaker.setchannels(1)
-            speaker.setrate(SAMPLES_PER_SECOND)
-            speaker.setformat(FORMAT)
-            speaker.setperiodsize(1000)
-            starttime = time.time()
-            f.seek(44)  # skip the wav header
-            while True:
-                samples = f.read(2000)
-                if not samples:
-                    break
-                speaker.write(samples)
-            duration = filesize/(BYTES_PER_SAMPLE * SAMPLES_PER_SECOND)
-            elapsed = time.time() - starttime
-            if duration > elapsed:
-                time.sleep(duration - elapsed)
 
+_tones = {}
+
+
+def _synthesize(frequency, duration):
+    numsamples = int(SAMPLES_PER_SECOND * duration)
+    i = np.arange(numsamples)
+    factor = 1 - i / numsamples
+    phase = (2 * math.pi * frequency / SAMPLES_PER_SECOND) * i
+    # Truncate towards zero, like int().
+    samples = (factor * 32000 * np.sin(phase)).astype(np.int16)
+    samples.flags.writeable = False
+    return samples
+
+
+# Number of frames written to the speaker at a time, i.e. 20ms of audio.
+PERIOD_SIZE = 320
+
+# WAV files start with a 44-byte header, which we skip.
+WAV_HEADER_SIZE = 44
+
+
+# Returns the samples of a sound file as an array of 16-bit samples. WAV
+# files must be single-channel, s16_le samples at 16000 samples per second,
+# other files are raw samples in this format.
+def read_samples(filename):
+    with open(filename, 'rb') as f:
+        if filename.lower().endswith('.wav'):
+            f.seek(WAV_HEADER_SIZE)
+        data = f.read()
+    # Ignore a trailing odd byte, if any.
+    return np.frombuffer(data[:len(data) // BYTES_PER_SAMPLE *
+                              BYTES_PER_SAMPLE], dtype=np.int16)
+
+
+#
+# This class is a sound being played by a Player. It is returned by
+# Player.play() and can be used to wait for the sound to finish, to change
+# its gain, or to stop it early, e.g. to interrupt a long prompt as soon as
+# we have something else to say.
+#
+class Sound(object):
+    def __init__(self, samples, gain=1.0):
+        self.samples = samples
+        self.gain = gain
+        self.position = 0
+        self.cancelled = False
+
+        # Time at which the sound started and will stop playing.
+        self.start_time = None
+        self.end_time = None
+        self.finished = Event()
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+    # Stop playing the sound.
+    def cancel(self):
+        self.cancelled = True
+
+    # Block until the sound has finished playing.
+    def wait(self):
+        self.finished.wait()
+        # The last samples were written to the speaker, but they are
+        # buffered by the kernel and may not have been played yet.
+        remaining = self.end_time - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    # Mark the sound as finished, called by the Player.
+    def finish(self, end_time):
+        self.end_time = end_time
+        self.finished.set()
+
+
+#
+# This class plays sounds through the speaker from a single worker thread.
+#
+# Opening and configuring an ALSA device for every sound takes time, and
+# prompts are played several times per interaction, so the speaker is opened
+# once, by the worker thread, and kept open.
+#
+# Sounds played at the same time, e.g. the shutter tone and a prompt, are
+# mixed together, each with its own gain, and written to the speaker one
+# period at a time, so that sounds can start and stop at any period.
+#
+# The player also keeps a cache of sound files: the prompts are preloaded at
+# startup with preload(), so that playing them doesn't read the disk.
+#
+class Player(object):
+    def __init__(self, device=None):
+        self.logger = logging.getLogger(__name__)
+        self.device = device
+        self.speaker = None
+        self.cache = {}
+
+        self.sounds = []
+        self.condition = Condition()
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.thread = Thread(name="audio-thread", target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Read the specified sound files into the cache.
+    def preload(self, filenames):
+        for filename in filenames:
+            try:
+                self.cache[filename] = read_samples(filename)
+            except IOError as err:
+                self.logger.error("Can't load sound %s: %s", filename, err)
+
+    # Returns the samples of a sound file, from the cache if it was
+    # preloaded. Other files, e.g. item descriptions which are recorded
+    # later on, are read every time.
+    def load(self, filename):
+        samples = self.cache.get(filename)
+        if samples is None:
+            samples = read_samples(filename)
+        return samples
+
+    # Start playing samples, as an array or bytes object like those returned
+    # by makebeep() and record(), multiplied by `gain`. If `wait` is True,
+    # block until the sound has finished playing. Returns the Sound.
+    def play(self, samples, gain=1.0, wait=True):
+        sound = Sound(np.frombuffer(samples, dtype=np.int16), gain)
+        with self.condition:
+            self.sounds.append(sound)
+            self.condition.notify()
+        if wait:
+            sound.wait()
+        return sound
+
+    # Stop playing all sounds.
+    def cancel_all(self):
+        with self.condition:
+            for sound in self.sounds:
+                sound.cancel()
+
+    def _open(self):
+        speaker = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK,
+                                card=self.device or ALSA_SPEAKER)
+        speaker.setchannels(1)
+        speaker.setrate(SAMPLES_PER_SECOND)
+        speaker.setformat(FORMAT)
+        speaker.setperiodsize(PERIOD_SIZE)
+        return speaker
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.sounds:
+                    self.condition.wait()
+                sounds = list(self.sounds)
+
+            try:
+                period = self._mix(sounds)
+                if self.speaker is None:
+                    self.speaker = self._open()
+                # write() blocks once the kernel buffer is full, which paces
+                # this loop.
+                self.speaker.write(period.tobytes())
+            except Exception:  # pylint: disable=broad-except
+                # This is the only audio thread, it must survive any error:
+                # otherwise, whoever waits for a sound would wait forever.
+                self.logger.exception("Can't play sound.")
+                # Drop the current sounds, and open the speaker again for
+                # the next ones.
+                self.speaker = None
+                now = time.time()
+                for sound in sounds:
+                    sound.cancel()
+                    if not sound.done:
+                        sound.finish(now)
+
+            with self.condition:
+                self.sounds = [sound for sound in self.sounds if
+                               not sound.done]
+
+    # Returns the next period of the mix of `sounds`. Sounds that are
+    # cancelled or that reach their end are marked as finished.
+    def _mix(self, sounds):
+        now = time.time()
+        mix = np.zeros(PERIOD_SIZE, dtype=np.float32)
+        for sound in sounds:
+            if sound.cancelled:
+                sound.finish(now)
+                continue
+
+            if sound.start_time is None:
+                sound.start_time = now
+            chunk = sound.samples[sound.position:
+                                  sound.position + PERIOD_SIZE]
+            mix[:len(chunk)] += chunk * sound.gain
+            sound.position += len(chunk)
+
+            if sound.position >= len(sound.samples):
+                sound.finish(sound.start_time +
+                              len(sound.samples) / SAMPLES_PER_SECOND)
+
+        return np.clip(np.rint(mix), -32768, 32767).astype(np.int16)
+
+
+_player = None
+
+
+# Returns the Player used by the functions below, started on first use.
+def get_player():
+    global _player
+    if _player is None:
+        _player = Player()
+        _player.start()
+    return _player
+
+
+# Start the player and read the specified sound files into its cache, so
+# that the first sounds play without delay.
+def preload(filenames):
+    get_player().preload(filenames)
+
+
+# Returns the samples of a sound file, from the cache if it was preloaded.
+def load(filename):
+    return get_player().load(filename)
+
+
+# Play the specified audio samples though the speakers, and block until the
+# sound has finished playing. This function expects an array or bytes object
+# like those returned by the makebeep() and record() functions.
+def play(samples, gain=1.0):
+    with instrumentation.span('audio'):
+        get_player().play(samples, gain)
+
+
+# Start playing the sound and return right away. The sound is mixed with any
+# other sound being played. Returns the Sound, which can be cancelled.
+def playAsync(samples, gain=1.0):
+    return get_player().play(samples, gain, wait=False)
+
+
+# Play a sound file. If `wait` is False, return the Sound right away, e.g. so
+# that a long prompt can be interrupted.
+def playfile(filename, gain=1.0, wait=True):
+    try:
+        samples = load(filename)
     except IOError as err:
         print("IO error: {0}".format(err))
+        return None
+
+    if not wait:
+        return get_player().play(samples, gain, wait=False)
+    with instrumentation.span('audio'):
+        return get_player().play(samples, gain)
+
+
+# Stop playing all sounds.
+def stop():
+    if _player is not None:
+        _player.cancel_all()
 
 
 #
@@ -102,6 +324,9 @@ def playfile(filename):
 # know when to stop recording, and it has a method to return the
 # samples as an array, with silence trimmed off the start and the end.
 #
+# Samples can be added one at a time with add(), or a chunk at a time with
+# add_chunk(), which gives exactly the same results using NumPy.
+#
 class Recording(object):
     def __init__(self,
                  window_size=256,
@@ -148,6 +373,63 @@ class Recording(object):
         else:
             self.silent_samples = 0
 
+    # Add a chunk of samples, as bytes, an array('h') or a NumPy array. This
+    # is equivalent to calling add() for every sample.
+    def add_chunk(self, chunk):
+        if isinstance(chunk, (bytes, bytearray, array)):
+            chunk = np.frombuffer(chunk, dtype=np.int16)
+        chunk = np.asarray(chunk, dtype=np.int64)
+        if len(chunk) == 0:
+            return
+
+        count = len(self.samples)
+        size = self.window_size
+
+        # The samples in the window before this chunk, oldest first, then
+        # the chunk.
+        window = np.frombuffer(self.window, dtype=np.int16)
+        history_start = max(0, count - size)
+        if count < size:
+            history = window[:count]
+        else:
+            history = np.roll(window, -(count % size))
+        raw = np.concatenate((history, chunk))
+
+        # Sum of the window of every sample of the chunk, i.e. of the
+        # `size` last samples, or of all the samples until there are enough.
+        sums = np.concatenate(([0], np.cumsum(raw)))
+        indices = np.arange(count, count + len(chunk))
+        window_starts = np.maximum(0, indices - size + 1)
+        window_sums = sums[indices - history_start + 1] - \
+            sums[window_starts - history_start]
+        averages = window_sums // np.minimum(indices + 1, size)
+
+        # the average is the dc component of the signal
+        # subtract it out
+        samples = np.clip(chunk - averages, -32768, 32767)
+        self.samples.extend(array('h', samples.astype(np.int16).tobytes()))
+
+        # Keep the window and its sum up to date for the next samples.
+        window = window.copy()
+        window[indices[-size:] % size] = chunk[-size:]
+        self.window = array('h', window.tobytes())
+        self.sum = int(window_sums[-1])
+
+        # The silence threshold changes whenever we see a new maximum.
+        maximums = np.maximum.accumulate(samples)
+        new_maximum = maximums > self.max
+        thresholds = np.where(new_maximum, maximums * self.silence_factor,
+                              self.silence_threshold)
+        if new_maximum[-1]:
+            self.max = int(maximums[-1])
+            self.silence_threshold = float(thresholds[-1])
+
+        loud = np.flatnonzero(samples >= thresholds)
+        if len(loud) == 0:
+            self.silent_samples += len(samples)
+        else:
+            self.silent_samples = len(samples) - 1 - int(loud[-1])
+
     def duration(self):
         return len(self.samples) / SAMPLES_PER_SECOND
 
@@ -159,13 +441,14 @@ class Recording(object):
     def get_audible_samples(self,
                             start_margin=SAMPLES_PER_SECOND//16,
                             end_margin=SAMPLES_PER_SECOND//8):
-        start = 0
-        end = len(self.samples) - 1
-        while start < len(self.samples) and \
-              self.samples[start] < self.silence_threshold:
-            start += 1
-        while end > start and self.samples[end] < self.silence_threshold:
-            end -= 1
+        samples = np.frombuffer(self.samples, dtype=np.int16)
+        loud = np.flatnonzero(samples >= self.silence_threshold)
+        if len(loud) > 0:
+            start = int(loud[0])
+            end = int(loud[-1])
+        else:
+            start = len(samples)
+            end = len(samples) - 1
 
         # adjust the start and end to allow a bit of silence
         # on both sides. Except not if everything is silence
@@ -175,32 +458,149 @@ class Recording(object):
 
         return self.samples[start:end+1]
 
+
+def _open_microphone(device=None):
+    mic = alsaaudio.PCM(alsaaudio.PCM_CAPTURE,
+                        card=device or ALSA_MICROPHONE)
+    mic.setchannels(1)
+    mic.setrate(SAMPLES_PER_SECOND)
+    mic.setformat(FORMAT)
+    mic.setperiodsize(CHUNK_SIZE)
+    return mic
+
+
+# Generator that yields the chunks of samples read from `mic`.
+def _read_chunks(mic):
+    while True:
+        length, chunk = mic.read()
+        # The length is negative if samples were lost.
+        if length > 0:
+            yield chunk
+
+
+#
+# This class keeps the microphone open and reads it continuously from a
+# worker thread, so that a recording can start without waiting for the
+# device to be opened and set up, which used to cut off the first syllable
+# of item names.
+#
+# The last `preroll` seconds of audio are kept in a ring buffer, along with
+# the time at which they were read, so that a recording can also start
+# retroactively, from a time in the recent past.
+#
+class Microphone(object):
+    def __init__(self, device=None, preroll=.5):
+        self.logger = logging.getLogger(__name__)
+        self.device = device
+
+        # Chunks are (end time, samples) tuples. Keep a second more than
+        # the pre-roll, so that slow readers don't miss chunks.
+        self.chunks = deque(maxlen=int(math.ceil((preroll + 1) /
+                                                 CHUNK_DURATION)))
+        # Total number of chunks read so far.
+        self.count = 0
+        # The error that prevents us from reading the microphone, if any.
+        self.error = None
+        self.condition = Condition()
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.thread = Thread(name="microphone-thread", target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Generator that yields the chunks of samples that started at or after
+    # `timestamp`, as returned by time.time(), then the new chunks as they
+    # are read. Raises the error of the microphone if it can't be read, or
+    # ALSAAudioError if no chunk comes in for READ_TIMEOUT seconds.
+    def chunks_since(self, timestamp):
+        with self.condition:
+            index = self.count
+            for (i, (end_time, _)) in enumerate(self.chunks):
+                if end_time - CHUNK_DURATION >= timestamp:
+                    index = self.count - len(self.chunks) + i
+                    break
+
+        while True:
+            with self.condition:
+                deadline = time.time() + READ_TIMEOUT
+                while self.count <= index:
+                    if self.error is not None:
+                        raise self.error
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise alsaaudio.ALSAAudioError(
+                            "No audio from the microphone")
+                    self.condition.wait(remaining)
+                oldest = self.count - len(self.chunks)
+                if index < oldest:
+                    self.logger.warning("Lost %d chunks of audio.",
+                                        oldest - index)
+                    index = oldest
+                (end_time, chunk) = self.chunks[index - oldest]
+            index += 1
+            # New chunks may have started before `timestamp` too.
+            if end_time - CHUNK_DURATION >= timestamp:
+                yield chunk
+
+    def _run(self):
+        while True:
+            try:
+                for chunk in _read_chunks(_open_microphone(self.device)):
+                    with self.condition:
+                        self.chunks.append((time.time(), chunk))
+                        self.count += 1
+                        self.error = None
+                        self.condition.notify_all()
+            except alsaaudio.ALSAAudioError as err:
+                self.logger.exception("Can't read the microphone.")
+                # Let readers know, and try again later.
+                with self.condition:
+                    self.error = err
+                    self.condition.notify_all()
+                time.sleep(1)
+
+
+_microphone = None
+
+
+# Keep the microphone open and the last `preroll` seconds of audio in
+# memory, see Microphone. Recordings then start right away.
+def arm_microphone(preroll):
+    global _microphone
+    if _microphone is None:
+        _microphone = Microphone(preroll=preroll)
+        _microphone.start()
+    return _microphone
+
+
 # Record audio from the microphone, trim off leading and trailing silence
 # and return an array of the audio samples. If no sound is detected at all
 # then the returned array will have a length of zero.
+#
+# If the microphone is armed, the recording starts at `since`, a time as
+# returned by time.time(), which can be up to the pre-roll duration in the
+# past. Otherwise, it starts when the microphone is opened.
 def record(min_duration=1,         # Record at least this many seconds
            max_duration=8,         # But no more than this many seconds
            max_silence=1,          # Stop recording after silence this long
            silence_threshold=DEFAULT_SILENCE_THRESHOLD, # Silence is < this
-           silence_factor=0.25):   # Or, less than this fraction of max
+           silence_factor=0.25,    # Or, less than this fraction of max
+           since=None):            # Start recording at this time
 
-    chunk_duration = 1.0/16        # record in batches this many seconds long
-    chunk_size = int(SAMPLES_PER_SECOND * chunk_duration)
-
-    mic = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, card=ALSA_MICROPHONE)
-    mic.setchannels(1)
-    mic.setrate(SAMPLES_PER_SECOND)
-    mic.setformat(FORMAT)
-    mic.setperiodsize(chunk_size)
+    if _microphone is not None:
+        chunks = _microphone.chunks_since(since or time.time())
+    else:
+        chunks = _read_chunks(_open_microphone())
 
     recording = Recording(silence_factor=silence_factor,
                           silence_threshold=silence_threshold)
 
-    while True:
-        _, chunk = mic.read()
-        chunkarray = array('h', chunk)
-        for sample in chunkarray:
-            recording.add(sample)
+    for chunk in chunks:
+        recording.add_chunk(chunk)
 
         # How long is the recording now?
         duration = recording.duration()
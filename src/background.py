@@ -0,0 +1,237 @@
+from __future__ import division
+
+import logging
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+import numpy as np
+import cv2
+
+from object_frame import ObjectFrame
+
+
+#
+# This class is a background model that is kept up to date while the camera
+# is running, so that foreground objects can be segmented right away when a
+# capture is requested, instead of bootstrapping a new background subtractor
+# from the first frames of every capture.
+#
+# The camera thread calls feed() with every frame it reads. Only `rate`
+# frames per second are actually downsampled (by `resample_factor`) and used
+# to update the model, which is cheap enough to run all the time.
+#
+# The model is only trusted once it has seen `warmup` frames. It is reset
+# whenever the camera is (re)started, as the scene may have changed while the
+# camera was off.
+#
+# Learning is paused during captures with pause() and resume(), otherwise the
+# object the user moves in front of the camera would end up in the
+# background.
+#
+class BackgroundModel(object):
+    def __init__(self, rate, resample_factor, warmup):
+        self.logger = logging.getLogger(__name__)
+        self.interval = 1 / rate
+        self.resample_factor = resample_factor
+        self.warmup = warmup
+
+        # The subtractor is updated by the camera thread and used by the
+        # thread that handles captures.
+        self.lock = Lock()
+        self.subtractor = None
+        self.updates = 0
+        self.last_update = 0
+        self.paused = False
+        self.reset()
+
+    # True if the model has seen enough frames to be used.
+    @property
+    def ready(self):
+        return self.updates >= self.warmup
+
+    def reset(self):
+        with self.lock:
+            self.subtractor = cv2.createBackgroundSubtractorKNN()
+            self.updates = 0
+            self.last_update = 0
+
+    # Stop learning from the frames we are fed, until resume() is called.
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    # Update the model with a full-size frame from the camera, unless we
+    # updated it less than 1 / rate seconds ago or learning is paused.
+    def feed(self, frame):
+        if self.paused:
+            return
+        now = time.time()
+        if now - self.last_update < self.interval:
+            return
+        self.last_update = now
+
+        downsampled_frame = cv2.resize(frame, (0, 0),
+                                       fx=self.resample_factor,
+                                       fy=self.resample_factor)
+        with self.lock:
+            self.subtractor.apply(downsampled_frame)
+            self.updates += 1
+
+    # Returns the foreground mask of a frame that was downsampled by
+    # `resample_factor`. Frames of a capture contain the object we want to
+    # segment, so they are not learned into the model.
+    def apply(self, downsampled_frame):
+        with self.lock:
+            return self.subtractor.apply(downsampled_frame, learningRate=0)
+
+
+#
+# This class extracts moving objects from frames while they are being
+# captured, instead of buffering all the frames and processing them once the
+# capture is over.
+#
+# Frames are pushed as soon as they are grabbed and a worker thread
+# downsamples them, feeds them to the background subtractor and computes the
+# mask of the moving object. Frames must go through the subtractor in order,
+# so there is a single worker. When the capture is over, finish() only has to
+# wait for the last few frames.
+#
+# The first `skip_frames` frames are only used to bootstrap the subtractor.
+# After that, we keep the results of the last `keep` frames: finish() returns
+# an (index, ObjectFrame) tuple for each of them in which we found a moving
+# object.
+#
+# Queued frames come from the camera's frame pool, so at most `max_queued`
+# frames wait in the queue: push() blocks until the worker catches up. If the
+# capture fails, stop() must be called so that the worker doesn't keep the
+# frames and the subtractor alive.
+#
+class SubtractionStage(object):
+    def __init__(self, subtract_background, resample_factor,
+                 discard_small_polygons, skip_frames, keep, max_queued):
+        self.logger = logging.getLogger(__name__)
+        self.subtract_background = subtract_background
+        self.resample_factor = resample_factor
+        self.discard_small_polygons = discard_small_polygons
+        self.skip_frames = skip_frames
+
+        # Object frames of the last `keep` frames, None where the frame didn't
+        # contain any object.
+        self.object_frames = deque(maxlen=keep)
+        self.error = None
+
+        # Frames waiting to be processed, None marks the end of the capture.
+        self.queue = deque()
+        self.max_queued = max_queued
+        self.condition = Condition()
+
+        self.thread = Thread(name="subtraction-thread", target=self._thread)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def push(self, frame):
+        with self.condition:
+            while len(self.queue) >= self.max_queued:
+                self.condition.wait()
+            self.queue.append(frame)
+            self.condition.notify_all()
+
+    # Wait until all the frames are processed and return the object frames.
+    def finish(self):
+        with self.condition:
+            self.queue.append(None)
+            self.condition.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return [(idx, object_frame) for (idx, object_frame) in
+                self.object_frames if object_frame is not None]
+
+    # Drop the frames that are still queued and wait for the worker to exit.
+    # Does nothing if finish() already returned.
+    def stop(self):
+        with self.condition:
+            self.queue.clear()
+            self.queue.append(None)
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _thread(self):
+        idx = 0
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                frame = self.queue.popleft()
+                self.condition.notify_all()
+            if frame is None:
+                return
+
+            try:
+                object_frame = self._extract_object(idx, frame)
+            except Exception as e:  # pylint: disable=broad-except
+                # Keep draining the queue, or push() would block forever.
+                # The error is raised by finish().
+                self.logger.exception("Can't extract object from frame %d",
+                                      idx)
+                self.error = e
+                object_frame = None
+
+            if idx >= self.skip_frames:
+                self.object_frames.append((idx, object_frame))
+            idx += 1
+
+    # Returns an ObjectFrame with the mask of the moving object, or None if
+    # there's no moving object in the frame.
+    def _extract_object(self, idx, frame):
+        resample_factor = self.resample_factor
+        downsampled_frame = cv2.resize(frame, (0, 0),
+                                       fx=resample_factor,
+                                       fy=resample_factor)
+        downsampled_subtraction = self.subtract_background(downsampled_frame)
+        _, downsampled_noisy_mask = cv2.threshold(downsampled_subtraction,
+                                                  200, 255, cv2.THRESH_BINARY)
+
+        # Experience shows that the background subtractor needs a few frames
+        # before it produces anything usable.
+        if idx < self.skip_frames:
+            return None
+
+        # Ok, at this stage, the background subtraction should be bootstrapped.
+        # We can make use of `downsampled_noisy_mask`.
+        downsampled_height, downsampled_width = downsampled_noisy_mask.shape[:2]
+
+        # Approximate everything by polygons, removing the smallest polygons.
+        # This has the double effect of:
+        # - getting rid of all contours that are too small;
+        # - restoring missing pixels inside the moving object.
+        _, contours, _ = cv2.findContours(downsampled_noisy_mask,
+                                          cv2.RETR_EXTERNAL,
+                                          cv2.CHAIN_APPROX_NONE)
+
+        downsampled_bw_mask = np.zeros((downsampled_height, downsampled_width),
+                                       np.uint8)
+        downsampled_surface = downsampled_height * downsampled_width
+        is_empty = True
+        for cnt in contours:
+            area = cv2.contourArea(cnt)
+            fraction = area / downsampled_surface
+            if fraction > self.discard_small_polygons:
+                is_empty = False
+                hull = cv2.convexHull(cnt)
+                cv2.fillPoly(downsampled_bw_mask, [hull], 255, 8)
+
+        if is_empty:
+            # This image isn't really useful, let's throw it away.
+            self.logger.info("Can't find any moving object on frame %d", idx)
+            return None
+
+        # Now that all the sophisticated computations are done, upsample the
+        # mask and use it to extract the object.
+        bw_mask = cv2.resize(downsampled_bw_mask, (0, 0),
+                             fx=1/resample_factor,
+                             fy=1/resample_factor,
+                             interpolation=cv2.INTER_NEAREST)
+        return ObjectFrame(frame, bw_mask)
@@ -0,0 +1,403 @@
+"""Benchmark of the matching pipeline against databases of growing size.
+
+Builds a database of synthetic (or replayed) items, and for every database
+size measures how long it takes to load the database, to extract the
+features of a captured image, to match them against the database and to rank
+the results. Timings are summarized with percentiles and written to a JSON
+file along with the high-water mark of memory usage. Every size is measured
+in a new process, so that its memory usage is its own, e.g.
+
+    python src/benchmark.py --sizes 10,100,1000 --output orb.json -- \\
+        --matching-detector orb --matching-orb-n-features 500
+
+Options after `--` are regular Lighthouse options, see config.py.
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+import numpy as np
+import cv2
+
+import config
+from frame_source import IMAGE_EXTENSIONS
+from image_database import ImageDatabase
+from image_description import ImageDescription, TooFewFeaturesException
+from item_store import ItemStore
+from object_frame import ObjectFrame
+
+# Number of random shapes drawn on synthetic images, to give detectors
+# something to find.
+SYNTHETIC_SHAPES = 40
+
+PERCENTILES = [50, 90, 99]
+
+# File of the work directory where the options the database was built with
+# are saved, see check_build().
+BUILD_FILE = 'build.json'
+
+
+# Returns a synthetic picture of an item, always the same for a given seed.
+def synthetic_image(seed, width, height):
+    random = np.random.RandomState(seed)
+
+    # Smooth random background.
+    image = random.randint(0, 256, (height // 16, width // 16, 3))
+    image = cv2.resize(image.astype(np.uint8), (width, height),
+                       interpolation=cv2.INTER_CUBIC)
+
+    for _ in range(SYNTHETIC_SHAPES):
+        color = tuple(int(c) for c in random.randint(0, 256, 3))
+        (x, y) = (int(random.randint(width)), int(random.randint(height)))
+        size = int(random.randint(5, min(width, height) // 6))
+        shape = random.randint(3)
+        if shape == 0:
+            cv2.circle(image, (x, y), size, color, -1)
+        elif shape == 1:
+            cv2.rectangle(image, (x, y), (x + size, y + size // 2), color, -1)
+        else:
+            cv2.putText(image, chr(ord('A') + random.randint(26)), (x, y),
+                        cv2.FONT_HERSHEY_SIMPLEX, size / 20, color, 2)
+    return image
+
+
+# Returns another picture of the same item, as if it was taken again: slightly
+# moved, rotated, scaled, with a different exposure and some noise.
+def perturb(image, seed):
+    random = np.random.RandomState(seed)
+    (height, width) = image.shape[:2]
+
+    transform = cv2.getRotationMatrix2D((width / 2, height / 2),
+                                        random.uniform(-10, 10),
+                                        random.uniform(.9, 1.1))
+    transform[:, 2] += random.uniform(-20, 20, 2)
+    image = cv2.warpAffine(image, transform, (width, height),
+                           borderMode=cv2.BORDER_REFLECT)
+
+    image = image * random.uniform(.8, 1.2) + \
+        random.normal(0, 4, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+# Read the images and the frames of the videos in `paths` (files or
+# directories), resized to the specified size, up to `limit` frames.
+def load_frames(paths, width, height, limit):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in
+                         sorted(os.listdir(path))
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            files.append(path)
+
+    frames = []
+    for path in files:
+        for image in read_images(path):
+            if len(frames) >= limit:
+                return frames
+            frames.append(cv2.resize(image, (width, height)))
+    return frames
+
+
+# Generator that yields the image in `path`, or the frames of the video.
+def read_images(path):
+    if path.lower().endswith(IMAGE_EXTENSIONS):
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is not None:
+            yield image
+        return
+
+    video = cv2.VideoCapture(path)
+    while True:
+        (ok, image) = video.read()
+        if not ok:
+            break
+        yield image
+    video.release()
+
+
+#
+# This class provides the pictures of the items of the benchmark database.
+# Pictures are synthetic, unless frames to replay are specified. If there are
+# fewer frames than items, frames are reused, perturbed to look like new
+# pictures.
+#
+class ItemPictures(object):
+    def __init__(self, width, height, frames=None):
+        self.width = width
+        self.height = height
+        self.frames = frames
+
+    def get(self, index):
+        if not self.frames:
+            return synthetic_image(index, self.width, self.height)
+
+        image = self.frames[index % len(self.frames)]
+        if index >= len(self.frames):
+            image = perturb(image, index)
+        return image
+
+
+def identifier(index):
+    return "item{:06d}".format(index)
+
+
+# Returns the summary of a list of durations, in seconds.
+def summarize(durations):
+    if not durations:
+        return {'count': 0}
+
+    summary = {
+        'count': len(durations),
+        'mean': float(np.mean(durations)),
+        'min': float(np.min(durations)),
+        'max': float(np.max(durations)),
+    }
+    for (percentile, value) in zip(PERCENTILES,
+                                   np.percentile(durations, PERCENTILES)):
+        summary['p{}'.format(percentile)] = float(value)
+    return summary
+
+
+# High-water mark of the resident set size of this process, or of the
+# largest of its terminated child processes, in bytes. Each size is measured
+# in a fresh process, so that this is the peak of that size only.
+def peak_rss(who=resource.RUSAGE_SELF):
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Add items to the store until it contains `size` items. Returns the time it
+# took to describe every new item.
+def grow_database(store, pictures, size):
+    durations = []
+    for index in range(len(store), size):
+        image = ObjectFrame(pictures.get(index))
+        start = timer()
+        try:
+            description = ImageDescription.from_image(image)
+        except TooFewFeaturesException:
+            # Items need features, use a new picture instead.
+            image = ObjectFrame(synthetic_image(index, pictures.width,
+                                                pictures.height))
+            description = ImageDescription.from_image(image)
+        durations.append(timer() - start)
+
+        store.append(identifier(index), description.features,
+                     description.histogram, description.keypoints)
+    return durations
+
+
+# Removes the database in `work_dir` if it was built by a run with other
+# build options, then records `build` for later runs. Items depend on these
+# options, so a reused --work-dir would otherwise measure stale items.
+def check_build(work_dir, db_path, build):
+    build_path = os.path.join(work_dir, BUILD_FILE)
+    try:
+        with open(build_path) as f:
+            previous = json.load(f)
+    except (IOError, ValueError):
+        previous = None
+
+    # Compare what would be written, JSON turns tuples into lists.
+    build = json.loads(json.dumps(build))
+    if previous != build and os.path.exists(db_path):
+        print("Database in {} was built with other options, "
+              "rebuilding it.".format(work_dir))
+        shutil.rmtree(db_path)
+
+    with open(build_path, 'w') as f:
+        json.dump(build, f, indent=2, sort_keys=True)
+
+
+def close_database(db):
+    if db.executor is not None:
+        db.executor.shutdown()
+
+
+# Load the database `repeats` times, and match `queries` pictures of random
+# items against it. Returns the results of the benchmark for this size.
+def measure(options, pictures, size, queries, repeats, seed):
+    result = {'items': size}
+
+    load = []
+    index = []
+    repeats = max(1, repeats)
+    for _ in range(repeats):
+        start = timer()
+        db = ImageDatabase(options)
+        load.append(timer() - start)
+
+        # Wait for the FLANN index to be built, if any.
+        start = timer()
+        thread = getattr(db.index, 'rebuild_thread', None)
+        if thread is not None:
+            thread.join()
+        index.append(timer() - start)
+
+        if len(load) < repeats:
+            close_database(db)
+
+    result['features'] = len(db.store.features)
+    result['load'] = summarize(load)
+    result['index'] = summarize(index)
+
+    stages = {'extract': [], 'match': [], 'rank': []}
+    random = np.random.RandomState(seed)
+    correct = 0
+    described = 0
+    for query in range(queries):
+        item = random.randint(size)
+        image = ObjectFrame(perturb(pictures.get(item), seed + query + 1))
+
+        start = timer()
+        try:
+            target = ImageDescription.from_image(image)
+        except TooFewFeaturesException:
+            continue
+        stages['extract'].append(timer() - start)
+        described += 1
+
+        start = timer()
+        scores = db.index.match(target)
+        stages['match'].append(timer() - start)
+
+        start = timer()
+        scores = db.rank(scores)
+        stages['rank'].append(timer() - start)
+
+        if scores and scores[0][1].dirname.endswith(identifier(item)):
+            correct += 1
+
+    close_database(db)
+
+    for (stage, durations) in stages.items():
+        result[stage] = summarize(durations)
+    result['accuracy'] = correct / described if described else None
+    result['rss_high_water_mark'] = peak_rss()
+    # Matching workers, if any, were terminated by close_database().
+    result['workers_rss_high_water_mark'] = peak_rss(
+        resource.RUSAGE_CHILDREN)
+    return result
+
+
+# Run measure() for the specified size in a new process and return its
+# results, so that memory usage isn't polluted by previous sizes.
+def measure_in_subprocess(size, work_dir):
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--measure-size',
+         str(size), '--work-dir', work_dir] + sys.argv[1:])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Lighthouse matching benchmark",
+        epilog="Options after -- are passed to Lighthouse.")
+    parser.add_argument('--sizes', help='Comma-separated database sizes to '
+                        'measure (default: 10,100,1000,10000)',
+                        default='10,100,1000,10000')
+    parser.add_argument('--queries', help='Number of images matched for each '
+                        'size (default: 50)', default=50, type=int)
+    parser.add_argument('--load-repeats', help='Number of times the database '
+                        'is loaded for each size (default: 3)', default=3,
+                        type=int)
+    parser.add_argument('--images', help='Build the database from these '
+                        'images, videos or directories of images instead of '
+                        'synthetic images. Can be specified multiple times.',
+                        action='append')
+    parser.add_argument('--seed', help='Seed of the random queries '
+                        '(default: 0)', default=0, type=int)
+    parser.add_argument('--work-dir', help='Directory where the database is '
+                        'built. It is reused by later runs, unless they use '
+                        'other matching or video options or images, in which '
+                        'case it is rebuilt (default: a temporary directory, '
+                        'removed afterwards)')
+    parser.add_argument('--output', help='JSON file where results are written '
+                        '(default: benchmark.json)', default='benchmark.json')
+    # Internal: measure a database that was already built in --work-dir, and
+    # print the results as JSON. See measure_in_subprocess().
+    parser.add_argument('--measure-size', type=int, help=argparse.SUPPRESS)
+    (args, lighthouse_argv) = parser.parse_known_args()
+    if lighthouse_argv and lighthouse_argv[0] == '--':
+        lighthouse_argv = lighthouse_argv[1:]
+
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='lighthouse-bench')
+    db_path = os.path.join(work_dir, 'db')
+    log_path = os.path.join(work_dir, 'log')
+    options = config.get_config(lighthouse_argv + ['--db-path', db_path,
+                                                   '--log-path', log_path])
+    ImageDescription.init(options)
+
+    frames = None
+    if args.images:
+        frames = load_frames(args.images, options.video_width,
+                             options.video_height, sizes[-1])
+    pictures = ItemPictures(options.video_width, options.video_height, frames)
+
+    if args.measure_size is not None:
+        result = measure(options, pictures, args.measure_size, args.queries,
+                         args.load_repeats, args.seed)
+        print(json.dumps(result))
+        return
+
+    build_options = dict((name, value) for (name, value) in
+                         sorted(vars(options).items())
+                         if name.startswith(('matching_', 'video_')))
+    results = {
+        'options': build_options,
+        'environment': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+        },
+        'replayed_frames': len(frames) if frames else 0,
+        'sizes': [],
+    }
+
+    try:
+        check_build(work_dir, db_path, {
+            'options': build_options,
+            'images': [os.path.abspath(path) for path in args.images or []],
+            'replayed_frames': results['replayed_frames'],
+        })
+
+        for size in sizes:
+            store = ItemStore(db_path)
+            build = grow_database(store, pictures, size)
+            del store
+
+            result = measure_in_subprocess(size, work_dir)
+            result['describe_items'] = summarize(build)
+            results['sizes'].append(result)
+
+            print("{} items, {} features: load {:.3f}s, extract {:.3f}s, "
+                  "match {:.3f}s, accuracy {}".format(
+                      size, result['features'],
+                      *[result[stage].get('p50', float('nan')) for stage in
+                        ('load', 'extract', 'match')] +
+                      [result['accuracy']]))
+
+            # Write results as we go, larger sizes can take a while.
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
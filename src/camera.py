@@ -1,61 +1,137 @@
 import logging
-from Queue import Queue
-from threading import Thread, Event, Timer
-import cv2
+import time
+from collections import deque
+from threading import Thread, Condition, Event
+
+from frame_pool import FramePool
 
 
 #
-# This class wraps cv2.VideoCapture, and the capture() method returns
-# still frames from a video source. To improve speed, the VideoCapture
-# object can be is created in advance by calling start(). You can call
+# This class wraps a frame source (see frame_source.py), and the capture()
+# method returns still frames from it. To improve speed, the source can be
+# opened in advance by calling start(). You can call
 # shutdown() to release the camera and its thread, but you don't need
 # to do this: it will be automatically shut down after a specified
 # period of inactivity.
 #
+# If `standby_fps` is set, the camera isn't released after a period of
+# inactivity but is kept open at this reduced frame rate instead ("warm
+# standby"), so the next capture doesn't pay the cost of opening the device
+# again. The normal frame rate is restored as soon as a frame is requested.
+# Note that, until then, the thread may be waiting up to 1 / standby_fps
+# seconds for a frame, so this shouldn't be too low.
+#
 # In order to make this work, however, this class runs a thread that
-# repeatedly calls grab() on the VideoCapture object to so that old
-# frames are not buffered up. Because of this background thread, calling
-# capture() returns the latest frame.
+# repeatedly reads frames from the source so that old frames
+# are not buffered up. The thread keeps the last few frames in a small ring
+# buffer, each with a sequence number, so that callers can get frames at
+# the real frame rate of the camera. Frames are views on preallocated
+# buffers (see FramePool) which are reused once callers drop them, so callers
+# must not keep frames they don't need anymore:
+#
+# - capture() returns the next frame;
+# - capture_latest() returns the most recent frame right away;
+# - capture_burst(n) returns the next n distinct frames.
+#
+# Sources that are `on_demand` (e.g. recorded frames replayed as fast as
+# possible) are only read when a frame is requested, so that no frame is
+# skipped.
 #
 class Camera(object):
-    def __init__(self, source, width=640, height=480, fps=15, shutdown_time=15):
+    def __init__(self, source, shutdown_time=15, buffer_size=4, standby_fps=0,
+                 background_model=None):
         self.logger = logging.getLogger(__name__)
 
-        # Parameters for the VideoCapture object
+        # The frame source, e.g. a VideoSource
         self.source = source
-        self.width = width
-        self.height = height
-        self.fps = fps
 
-        # How long we wait before shutting the VideoCapture object and its
-        # thread down
+        # How long we wait before shutting the source and its
+        # thread down, or before putting it in standby
         self.shutdown_time = shutdown_time
+        self.standby_fps = standby_fps
 
         # This is the thread that controls the camera
         self.thread = None
 
-        # We request a picture from the camera thread by setting this flag
-        self.picture_flag = Event()
+        # The camera thread puts (sequence number, frame) tuples in this ring
+        # buffer, and notifies the condition whenever a new frame is ready.
+        # `latest` is the last of these tuples, it is only ever replaced so
+        # it can be read without locking.
+        self.frames = deque(maxlen=buffer_size)
+        self.latest = None
+        self.sequence = 0
+        self.condition = Condition()
 
-        # The camera thread returns the picture by putting it on this queue
-        self.queue = Queue()
+        # Number of frames requested from on-demand sources that the camera
+        # thread hasn't read yet.
+        self.requests = 0
+
+        # Frames are decoded in the buffers of this pool. The ring buffer
+        # holds on to `buffer_size` of them, so we need at least two more:
+        # one for the frame being decoded, and one for the caller.
+        self.pool = FramePool(buffer_size + 2)
+
+        # If set, a BackgroundModel that we keep up to date with the frames
+        # we read.
+        self.background_model = background_model
+
+        # Time after which the camera thread shuts the camera down (or puts
+        # it in standby), pushed back whenever a frame is requested.
+        self.deadline = 0
 
         # We set this flag when we want the camera thread to release the
         # camera and exit
         self.shutdown_flag = Event()
 
-    # Return the most recently grabbed frame from the camera, starting
-    # the camera if necessary.
+    # Return the next frame from the camera, starting the camera if
+    # necessary.
     def capture(self):
         self.logger.debug("Capture is requested.")
-        self.start()             # start the camera if necessary
-        self.picture_flag.set()  # ask for a picture
-        image = self.queue.get() # block until it appears on the queue
-        return image
+        return self.capture_burst(1)[0]
+
+    # Return the most recent frame from the camera without waiting for a new
+    # one, unless the camera has just been started.
+    def capture_latest(self):
+        self.start()
+
+        latest = self.latest
+        if latest is None:
+            latest = self._wait_for_frames(self.sequence)[-1]
+        return latest[1]
+
+    # Return the next `count` distinct frames from the camera, starting the
+    # camera if necessary. If the caller is slower than the camera, frames
+    # that were dropped from the ring buffer are skipped.
+    def capture_burst(self, count):
+        self.start()
+
+        last_sequence = self.sequence
+
+        images = []
+        while len(images) < count:
+            frames = self._wait_for_frames(last_sequence)
+            images.extend(image for (_, image) in frames[:count - len(images)])
+            last_sequence = frames[-1][0]
+
+        return images
+
+    # Block until frames newer than `sequence` are available and return them
+    # as a list of (sequence number, frame) tuples.
+    def _wait_for_frames(self, sequence):
+        with self.condition:
+            if self.sequence <= sequence:
+                self.requests += 1
+                self.condition.notify_all()
+            while self.sequence <= sequence:
+                # The camera may be shut down while we're waiting.
+                self.condition.wait(self.shutdown_time)
+                self.start()
+            return [frame for frame in self.frames if frame[0] > sequence]
 
     # Call this to start the camera. If you know you'll need it soon,
     # you can call this in advance of capture to speed things up a bit.
     def start(self):
+        self.deadline = time.time() + self.shutdown_time
         if self.thread:
             self.logger.debug("Capture thread is already started.")
             return
@@ -69,36 +145,77 @@ class Camera(object):
     # so you shouldn't have to call it manually.
     def shutdown(self):
         self.shutdown_flag.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    # For on-demand sources, wait until a frame is requested or until the
+    # camera becomes inactive. Returns True if a frame is requested.
+    def _wait_for_request(self, standby):
+        with self.condition:
+            if self.requests == 0 and not self.shutdown_flag.is_set():
+                timeout = None if standby else \
+                    max(0, self.deadline - time.time())
+                self.condition.wait(timeout)
+            if self.requests == 0:
+                return False
+            self.requests -= 1
+            return True
 
     def _thread(self):
-        camera = cv2.VideoCapture(self.source)
+        camera = self.source
 
         # FIXME: We should do something about it, either crash entire program
         # or use a loop with few seconds delay that will be constantly trying
         # to open camera, that will crash program after several attempts anyway.
-        if camera is None or not camera.isOpened():
+        if not camera.open():
             logging.error("Can't open camera.")
+            camera.release()
+            self.thread = None
             return
 
-        camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
-        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
-        camera.set(cv2.CAP_PROP_FPS, self.fps)
-
-        shutdown_timer = Timer(self.shutdown_time, self.shutdown)
-        shutdown_timer.start()
+        if self.background_model is not None:
+            self.background_model.reset()
 
+        standby = False
         while not self.shutdown_flag.is_set():
-            camera.grab()
-            if self.picture_flag.is_set():
-                self.logger.debug("Retrieving a new frame.")
-                _, image = camera.retrieve()
-                shutdown_timer.cancel()
-                shutdown_timer = Timer(self.shutdown_time, self.shutdown)
-                shutdown_timer.start()
-                self.queue.put(image)
-                self.picture_flag.clear()
-
-        # Exiting
+            expired = time.time() >= self.deadline
+            if expired and not self.standby_fps:
+                self.logger.debug("Camera is inactive, shutting down.")
+                break
+            if expired != standby:
+                standby = expired
+                camera.set_frame_rate(self.standby_fps if standby else
+                                      camera.fps)
+                self.logger.debug("Camera standby: %s", standby)
+
+            if camera.on_demand and not self._wait_for_request(standby):
+                continue
+
+            if not camera.grab():
+                continue
+
+            # Decode the frame in place in a free buffer of the pool.
+            buffer = self.pool.acquire()
+            ok, image = camera.retrieve(buffer)
+            if not ok:
+                continue
+            if image is not buffer:
+                self.pool.adopt(image)
+            frame = self.pool.view(image)
+
+            with self.condition:
+                self.sequence += 1
+                self.latest = (self.sequence, frame)
+                self.frames.append(self.latest)
+                self.condition.notify_all()
+
+            if self.background_model is not None:
+                self.background_model.feed(frame)
+
+        # Exiting. Don't serve stale frames once the camera restarts.
+        with self.condition:
+            self.frames.clear()
+            self.latest = None
         self.thread = None
         self.shutdown_flag.clear()
         camera.release()
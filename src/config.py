@@ -6,7 +6,9 @@ import os
 
 # XXX Commented out arguments are for experimental code that is
 # not currently in use
-def get_config():
+#
+# Options are parsed from `argv`, or from the command line if it is None.
+def get_config(argv=None):
     parser = argparse.ArgumentParser(description="Lighthouse prototype")
 
     #
@@ -29,18 +31,21 @@ def get_config():
     group = parser.add_argument_group(title="Image acquisition (default values are generally fine).")
 
     group.add_argument('--video-source', help='Use this video source for image capture (default: built-in cam).', default=0)
-    group.add_argument('--image-source', help='Use this image instead of a video source. Can be specified multiple times. Incompatible with --video-source.', action='append')
+    group.add_argument('--image-source', help='Replay this image, video file or directory of images instead of a video source. Can be specified multiple times. Incompatible with --video-source.', action='append')
+    group.add_argument('--image-source-pace', help='How to replay --image-source: "realtime" (at --video-fps) or "fast" (as fast as frames are requested, without skipping any) (default: realtime).', choices=['realtime', 'fast'], default='realtime')
 
     group.add_argument('--video-width', help='Video width for capture (default: 640).', default=640, type=int)
     group.add_argument('--video-height', help='Video height for capture (default: 480).', default=480, type=int)
     group.add_argument('--video-fps', help='Video frame rate in FPS (default: 15).', default=15, type=int)
+    group.add_argument('--video-standby-fps', help='Keep the video source open at this frame rate in FPS when it is inactive instead of releasing it, 0 to release it (default: 0).', default=0, type=int)
     group.add_argument('--video-resample-factor', help='Resampling factor to apply before motion detection (default: .3). Lower values increase speed but decrease quality.', default=.3, type=float)
 
     group.add_argument('--motion-background-removal-strategy', help='Strategy for removing the background (default: "now-you-see-me"). Can be "keep-everything" (don\'t remove the background), "now-you-see-me" (take a picture without the object then with the object) or "moving-object" (move the object in front of the camera for a second).', default='now-you-see-me', choices=['keep-everything', 'now-you-see-me', 'moving-object'])
-    group.add_argument('--motion-stability-factor', metavar='S', help='Determine when two consecutive frames are considered stable. We check if ||(frame_1, frame_2)|| / surface <= S. (default: .1)', default=.1, type=float)
+    group.add_argument('--motion-stability-factor', metavar='S', help='Determine when two consecutive frames are considered stable. We check if ||(frame_1, frame_2)|| / surface <= S, where the difference is computed on small grayscale thumbnails and scaled to the size of the frames, which is typically 2 to 10 times lower than the difference of full frames (default: .04)', default=.04, type=float)
     group.add_argument('--motion-stability-duration', help='Number of successive stable frames before we assume that the user has stopped moving the object (default: 5).', default=5, type=int)
     group.add_argument('--motion-blur-radius', default=25, type=int)
     group.add_argument('--motion-skip-frames', help='Number of frames we should skip to let background extraction initialize itself properly (default: 20).', default=20, type=int)
+    group.add_argument('--motion-background-model-rate', metavar='HZ', help='With the "moving-object" strategy, keep a background model up to date while the camera is running, using HZ frames per second, so that captures don\'t have to skip frames to initialize background extraction. The model is reset whenever the camera is started, so this works best with --video-standby-fps (default: 0, disabled).', default=0, type=float)
     group.add_argument('--motion-discard-small-polygons', metavar='MIN_FRACTION', help='Discard polygons whose pixel surface is smaller than MIN_FRACTION (default: .1).', default=.1, type=float)
 
     #
@@ -51,10 +56,14 @@ def get_config():
 
     group.add_argument('--matching-detector', help='Feature detector to use (default: orb)',
                        choices=['orb', 'akaze', 'surf'], default='orb')
-    group.add_argument('--matching-matcher', help='Matcher to use (default: brute-force)', choices=['brute-force', 'flann'],
+    group.add_argument('--matching-matcher', help='Matcher to use (default: brute-force). numpy-hamming only works with binary features (orb, akaze)', choices=['brute-force', 'flann', 'numpy-hamming'],
                        default='brute-force')
+    group.add_argument('--matching-flann-rebuild-threshold', help='With the flann matcher, number of items that can be registered before the index is rebuilt in the background. Until then, new items are matched by brute force (default: 10)', default=10, type=int)
     group.add_argument('--matching-ratio-test-k', help='Ratio test coefficient (default: 0.8)', default=0.8, type=float)
     group.add_argument('--matching-histogram-weight', help='How much weight to give to histogram correlation when matching images', default=5.0, type=float)
+    group.add_argument('--matching-histogram-shortlist', metavar='K', help='Only match features against the K items whose color histograms correlate best with the image (default: 0, match against all items)', default=0, type=int)
+    group.add_argument('--matching-workers', help='Number of worker processes used to match images against the database. Not used by the flann matcher (default: 0, match in the main process)', default=0, type=int)
+    group.add_argument('--matching-extraction-threads', help='Number of threads used to extract features from captured frames (default: 4)', default=4, type=int)
     group.add_argument('--matching-n-frames', help='How many frames to capture for matching (default: 10)', default=10,
                        type=int)
     group.add_argument('--matching-orb-n-features',
@@ -102,6 +111,20 @@ def get_config():
                        help='Directory where all possible logs are stored (default: ~/Lighthouse/Log)',
                        default='~/Lighthouse/Log')
 
+    group.add_argument('--log-image-format',
+                       help='Image format of the match pictures saved in the log directory (default: png)',
+                       choices=['png', 'jpeg'], default='png')
+    group.add_argument('--log-image-quality',
+                       help='Quality of the match pictures saved in the log directory, with the jpeg format (default: 90)',
+                       default=90, type=int)
+    group.add_argument('--log-sample-rate',
+                       help='Fraction of the matches whose pictures are saved in the log directory (default: 1.0)',
+                       default=1.0, type=float)
+
+    group.add_argument('--log-timings-interval',
+                       help='Log latency statistics of every stage of the pipeline every N seconds, and save them to timings.json in the log directory. They are also dumped on SIGUSR1 (default: 0, only on SIGUSR1)',
+                       metavar='N', default=0, type=float)
+
     group.add_argument('--web-server',
                        help='Indicates whether we want to run web server on device (default: false).',
                        action='store_true')
@@ -117,9 +140,12 @@ def get_config():
     group.add_argument('--silence-factor',
                        help='mic levels below this fraction of the highest levels seen are also treated as silence (default: 0.25)',
                        default=0.25, type=float)
+    group.add_argument('--audio-preroll',
+                       help='Keep the microphone open and the last SECONDS of audio in memory, so that recordings start without waiting for the device (default: 0, the microphone is opened for every recording)',
+                       metavar='SECONDS', default=0, type=float)
 
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     #
     # Ensure consistency.
@@ -0,0 +1,266 @@
+from __future__ import division
+
+import logging
+import time
+import numpy as np
+
+import image_description
+
+
+#
+# This class keeps the features of every item of the database stacked in one
+# contiguous matrix, together with a table that maps every row of the matrix
+# back to the item it belongs to. Rows of item number i are
+# features[offsets[i]:offsets[i + 1]].
+#
+# Matching a new scene against the whole database then takes a single k-NN
+# search: every stored feature is matched against the features of the scene,
+# and the ratio test survivors are tallied per item in one pass. This gives
+# exactly the same scores as calling ImageDescription.compare_to() on every
+# item, without paying for one knnMatch() call per item.
+#
+# The color histograms of all items are kept in one matrix too, centered and
+# normalized so that a single matrix product gives the correlation of the
+# scene with every item. If `shortlist` is set, only the features of the
+# `shortlist` items whose histograms correlate best with the scene are matched.
+#
+# If a MatchingExecutor is specified, the features are matched by its pool of
+# worker processes instead of the current process.
+#
+class DescriptorIndex(object):
+    # `features`, if specified, must already contain the features of `items`
+    # stacked in the same order (e.g. the memory-mapped features of an
+    # ItemStore), in which case they are used as-is instead of being copied.
+    # Similarly, the number of features of every item and their histograms
+    # can be specified as arrays, in which case `items` can be LazyItems
+    # that are only loaded when they are part of a result.
+    def __init__(self, items=(), features=None, shortlist=0, executor=None,
+                 counts=None, histograms=None):
+        self.logger = logging.getLogger(__name__)
+        self.items = items if isinstance(items, LazyItems) else list(items)
+        self.shortlist = shortlist
+        self.executor = executor
+
+        if histograms is None:
+            histograms = [np.ravel(item.histogram) for item in self.items]
+        if len(histograms) > 0:
+            self.histograms = self._center_rows(histograms).astype(
+                np.float32)
+        else:
+            self.histograms = np.zeros(0, dtype=np.float32)
+
+        if counts is None:
+            counts = [len(item.features) for item in self.items]
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.item_ids = np.repeat(np.arange(len(counts), dtype=np.intp),
+                                  counts)
+
+        if features is not None:
+            assert len(features) == self.offsets[-1]
+            self.features = features
+        elif self.items:
+            self.features = np.concatenate([item.features for item in
+                                            self.items])
+        else:
+            self.features = None
+
+    # Append a newly registered item to the index. `features`, if specified,
+    # must be the stacked features of all items, including the new one.
+    def add(self, item, features=None):
+        item_id = len(self.items)
+        self.items.append(item)
+        self.offsets = np.append(self.offsets,
+                                 self.offsets[-1] + len(item.features))
+        self.item_ids = np.append(self.item_ids,
+                                  np.full(len(item.features), item_id,
+                                          dtype=np.intp))
+
+        histogram = self._center(item.histogram)[np.newaxis, :]
+        if len(self.histograms) > 0:
+            self.histograms = np.concatenate([self.histograms, histogram])
+        else:
+            self.histograms = histogram
+
+        if features is not None:
+            assert len(features) == self.offsets[-1]
+            self.features = features
+        elif self.features is None:
+            self.features = np.array(item.features)
+        else:
+            self.features = np.concatenate([self.features, item.features])
+
+    # Match the description of a scene against every item of the index.
+    # The return value is an (unsorted) list of (score, item) tuples, the
+    # scores being the same as the ones computed by
+    # ImageDescription.compare_to().
+    def match(self, target):
+        if not self.items:
+            return []
+
+        start = time.time()
+        correlations = self.histograms.dot(self._center(target.histogram))
+
+        # Coarse stage: only keep the items whose colors look like the scene.
+        if 0 < self.shortlist < len(self.items):
+            candidates = np.argpartition(-correlations,
+                                         self.shortlist - 1)[:self.shortlist]
+        else:
+            candidates = np.arange(len(self.items))
+
+        (rows, scene_indices, distances) = self._good_matches(target,
+                                                              candidates)
+
+        # Several features of the scene can match the same item (with FLANN),
+        # make sure that the score stays a percentage.
+        good_matches = np.minimum(np.bincount(self.item_ids[rows],
+                                              minlength=len(self.items)),
+                                  np.diff(self.offsets))
+        scores = self._scores(target, good_matches, correlations, candidates)
+        self._keep_good_matches(target, rows, scene_indices, distances)
+
+        self.logger.debug("Matched %s features against %s/%s items in %ss "
+                          "(good matches: %s)", len(target.features),
+                          len(candidates), len(self.items),
+                          time.time() - start, len(rows))
+
+        return scores
+
+    # Returns the good matches with the scene, as a tuple of arrays (rows of
+    # the stacked features, indices of the scene features, distances). Only
+    # the items listed in `candidates` need to be considered.
+    def _good_matches(self, target, candidates):
+        if len(candidates) == len(self.items):
+            candidates = None
+
+        if self.executor is not None:
+            return self.executor.good_matches(self, target.features,
+                                              candidates)
+
+        return self.find_good_matches(0, len(self.features), target.features,
+                                      candidates)
+
+    # Find the good matches with the features of the scene among the rows
+    # [start, end) of the stacked features, see _good_matches(). If
+    # `candidates` is specified, only the rows of these items are matched.
+    def find_good_matches(self, start, end, scene_features, candidates=None):
+        if candidates is None:
+            ranges = [(start, end)]
+        else:
+            ranges = self._candidate_ranges(start, end, candidates)
+
+        # Rows are matched by contiguous ranges, which are views on the
+        # (memory-mapped) features rather than copies.
+        results = [(np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),
+                    np.zeros(0, dtype=np.float32))]
+        for (first, last) in ranges:
+            # Stored features are the query, scene features are the train
+            # set, in the same order as in ImageDescription.compare_to().
+            (good, indices, distances) = image_description.ratio_test(
+                self.features[first:last], scene_features)
+            results.append((np.flatnonzero(good) + first, indices[good],
+                            distances[good]))
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+    # Returns the (first, last) ranges of rows of the candidate items, within
+    # the rows [start, end). Consecutive items are merged into one range.
+    def _candidate_ranges(self, start, end, candidates):
+        candidates = np.unique(candidates)
+        breaks = np.flatnonzero(np.diff(candidates) != 1) + 1
+        ranges = []
+        for run in np.split(candidates, breaks):
+            if len(run) == 0:
+                continue
+            first = max(start, self.offsets[run[0]])
+            last = min(end, self.offsets[run[-1] + 1])
+            if first < last:
+                ranges.append((int(first), int(last)))
+        return ranges
+
+    # Keep the good matches of every item on the description of the scene,
+    # so that we can draw them without matching again.
+    def _keep_good_matches(self, target, rows, scene_indices, distances):
+        order = np.argsort(rows, kind='mergesort')
+        rows = rows[order]
+        scene_indices = scene_indices[order]
+        distances = distances[order]
+
+        bounds = np.searchsorted(rows, self.offsets)
+        for item_id in np.unique(self.item_ids[rows]):
+            (start, end) = (bounds[item_id], bounds[item_id + 1])
+            target.good_matches[self.items[item_id]] = (
+                rows[start:end] - self.offsets[item_id],
+                scene_indices[start:end],
+                distances[start:end])
+
+    # Turn the number of good matches and the histogram correlation of the
+    # candidates into (score, item) tuples.
+    def _scores(self, target, good_matches, correlations, candidates):
+        total_matches = np.diff(self.offsets)
+
+        scores = []
+        for candidate in candidates:
+            item = self.items[candidate]
+            total = total_matches[candidate]
+
+            # Items without any feature can't match anything, and don't get
+            # any histogram boost either.
+            if total == 0 or len(target.features) == 0:
+                scores.append((0, item))
+                continue
+
+            score = good_matches[candidate] / total * 100
+
+            if image_description.histogram_weight:
+                score += image_description.histogram_weight * \
+                    correlations[candidate]
+
+            scores.append((score, item))
+
+        return scores
+
+    # Center and normalize a histogram, so that the dot product of two such
+    # histograms is their correlation, as computed by cv2.compareHist() with
+    # cv2.HISTCMP_CORREL.
+    @staticmethod
+    def _center(histogram):
+        histogram = np.asarray(histogram, dtype=np.float64).ravel()
+        return DescriptorIndex._center_rows(histogram[np.newaxis, :])[0]
+
+    # Center and normalize every row of a matrix of histograms at once, see
+    # _center().
+    @staticmethod
+    def _center_rows(histograms):
+        histograms = np.array(histograms, dtype=np.float64)
+        histograms -= histograms.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(histograms, axis=1, keepdims=True)
+        histograms /= np.where(norms > 0, norms, 1)
+        return histograms
+
+
+#
+# A list of items that are only created by `load(index)` the first time they
+# are accessed, so that opening a database doesn't take time proportional to
+# the number of items. Items appended to the list are kept as-is.
+#
+class LazyItems(object):
+    def __init__(self, count, load):
+        self.loaded = [None] * count
+        self.load = load
+
+    def __len__(self):
+        return len(self.loaded)
+
+    def __getitem__(self, index):
+        item = self.loaded[index]
+        if item is None:
+            item = self.load(index % len(self.loaded))
+            self.loaded[index] = item
+        return item
+
+    def __iter__(self):
+        for index in range(len(self.loaded)):
+            yield self[index]
+
+    def append(self, item):
+        self.loaded.append(item)
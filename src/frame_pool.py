@@ -0,0 +1,84 @@
+import logging
+import sys
+import numpy as np
+
+
+#
+# This class is a pool of preallocated frame buffers, so that the camera can
+# decode frames in place instead of allocating a new array for every frame.
+#
+# Frames are handed out as views on the buffers of the pool. A view keeps a
+# reference to its buffer, and so does any slice of it, so a buffer can be
+# reused as soon as nobody holds a view on it anymore: we find out by looking
+# at the reference count of the buffers. If all the buffers are in use (e.g.
+# because a capture loop keeps a window of frames), the pool grows. Once the
+# extra buffers are released, the pool shrinks back to `size` buffers.
+#
+# All the buffers have the shape of the last frame that was adopted. If the
+# video source changes its frame size, the pool is simply reset and buffers
+# that are still in use are left to the garbage collector.
+#
+class FramePool(object):
+    def __init__(self, size):
+        self.logger = logging.getLogger(__name__)
+        self.size = size
+        self.buffers = []
+        self.shape = None
+        self.dtype = None
+
+        # Reference count of a buffer that is only referenced by the pool, as
+        # seen by _refcounts(). This is measured rather than hardcoded, as it
+        # depends on the Python implementation.
+        self.free_refcount = self._refcounts([np.empty(0)])[0]
+
+    # Returns a buffer nobody is using, or None if we don't know the shape of
+    # frames yet.
+    def acquire(self):
+        if self.shape is None:
+            return None
+
+        refcounts = self._refcounts(self.buffers)
+        free = [buffer for (buffer, refcount) in zip(self.buffers, refcounts)
+                if refcount <= self.free_refcount]
+        if free:
+            self._trim(free[1:])
+            return free[0]
+
+        self.logger.debug("All %s frame buffers are in use, adding one.",
+                          len(self.buffers))
+        self._allocate()
+        return self.buffers[-1]
+
+    # Use `frame`, which wasn't decoded in one of our buffers, as the first
+    # buffer of the pool, and allocate the other ones with the same shape.
+    def adopt(self, frame):
+        if self.shape is not None:
+            self.logger.debug("Frame size changed from %s to %s, resetting "
+                              "frame pool.", self.shape, frame.shape)
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self.buffers = [frame]
+        while len(self.buffers) < self.size:
+            self._allocate()
+
+    # Returns a view on a buffer of the pool, to hand out to callers.
+    @staticmethod
+    def view(buffer):
+        return buffer.view()
+
+    # Drop free buffers until the pool is back to its nominal size.
+    def _trim(self, free):
+        excess = len(self.buffers) - self.size
+        if excess <= 0:
+            return
+        drop = set(id(buffer) for buffer in free[:excess])
+        self.buffers = [buffer for buffer in self.buffers if
+                        id(buffer) not in drop]
+        self.logger.debug("Released %s frame buffers.", len(drop))
+
+    def _allocate(self):
+        self.buffers.append(np.empty(self.shape, dtype=self.dtype))
+
+    @staticmethod
+    def _refcounts(buffers):
+        return [sys.getrefcount(buffer) for buffer in buffers]
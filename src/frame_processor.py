@@ -0,0 +1,40 @@
+from multiprocessing.pool import ThreadPool
+
+import instrumentation
+from image_description import ImageDescription, TooFewFeaturesException
+
+
+# Returns the (frame, description) of a frame. The description is None if we
+# can't find enough features in the frame.
+def _describe(frame):
+    with instrumentation.span('extract'):
+        try:
+            return (frame, ImageDescription.from_image(frame))
+        except TooFewFeaturesException:
+            return (frame, None)
+
+
+#
+# This class extracts the descriptions of captured frames in a pool of
+# threads. OpenCV releases the GIL while it detects features, so the frames
+# are really processed concurrently.
+#
+# Descriptions are streamed back in the order in which they are ready, so
+# callers can start working on the first one while the others are still being
+# extracted.
+#
+class FrameProcessor(object):
+    def __init__(self, threads):
+        self.pool = ThreadPool(threads) if threads > 1 else None
+
+    # Generator that yields a (frame, description) tuple for each frame as
+    # soon as its description is ready. The description is None if the frame
+    # doesn't have enough features.
+    def describe(self, frames):
+        if self.pool is None:
+            for frame in frames:
+                yield _describe(frame)
+            return
+
+        for result in self.pool.imap_unordered(_describe, frames):
+            yield result
@@ -0,0 +1,179 @@
+from __future__ import division
+
+import logging
+import os
+import time
+import cv2
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+#
+# Frame sources are what the Camera reads frames from. They all have the
+# same interface, which follows the one of cv2.VideoCapture:
+#
+# - open() opens the source and returns True on success;
+# - grab() moves to the next frame and returns True on success;
+# - retrieve(buffer) decodes the current frame and returns an (ok, frame)
+#   tuple. The frame is decoded in `buffer` if it has the right shape;
+# - set_frame_rate(fps) changes the frame rate, e.g. to put the source in
+#   standby, while `fps` is the nominal frame rate;
+# - release() closes the source.
+#
+# If `on_demand` is True, the Camera only grabs a frame when one is requested,
+# instead of grabbing frames continuously.
+#
+
+
+#
+# This class is a live video source, i.e. a camera or a video stream opened
+# with cv2.VideoCapture.
+#
+class VideoSource(object):
+    on_demand = False
+
+    def __init__(self, source, width=640, height=480, fps=15):
+        # Device numbers may be specified as strings, e.g. on the command line.
+        if isinstance(source, str) and source.isdigit():
+            source = int(source)
+        self.source = source
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.source)
+        if self.capture is None or not self.capture.isOpened():
+            return False
+
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        self.capture.set(cv2.CAP_PROP_FPS, self.fps)
+        return True
+
+    def grab(self):
+        return self.capture.grab()
+
+    def retrieve(self, buffer=None):
+        return self.capture.retrieve(buffer)
+
+    def set_frame_rate(self, fps):
+        self.capture.set(cv2.CAP_PROP_FPS, fps)
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+
+#
+# This class replays recorded frames as if they came from a camera, so that
+# the acquisition and matching pipeline can run without a camera, and
+# repeatably. `paths` is a list of:
+#
+# - image files;
+# - video files;
+# - directories, e.g. a recorded capture session, whose image files are
+#   replayed in the order of their names.
+#
+# Frames are resized to `width` x `height` if needed, and replayed in a loop.
+#
+# With `realtime`, frames are replayed at `fps` frames per second. Otherwise,
+# they are replayed as fast as they are requested, without skipping any: the
+# same capture then always sees the same frames, whatever the speed of the
+# machine.
+#
+class ReplaySource(object):
+    def __init__(self, paths, width=640, height=480, fps=15, realtime=True):
+        self.logger = logging.getLogger(__name__)
+        self.paths = paths
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.realtime = realtime
+        self.on_demand = not realtime
+
+        # Files to replay, and the position of the current one.
+        self.files = []
+        self.position = -1
+        self.video = None
+        self.image_file = None
+
+        self.interval = 1 / fps
+        self.next_frame_time = None
+
+    def open(self):
+        self.files = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                self.files.extend(
+                    os.path.join(path, name) for name in sorted(os.listdir(path))
+                    if name.lower().endswith(IMAGE_EXTENSIONS))
+            elif os.path.isfile(path):
+                self.files.append(path)
+            else:
+                self.logger.error("Can't find image source %s", path)
+
+        self.position = -1
+        self.next_frame_time = time.time()
+        return len(self.files) > 0
+
+    def grab(self):
+        if self.realtime:
+            # Frame times are computed from the time of the first frame, so
+            # that delays don't accumulate.
+            delay = self.next_frame_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_frame_time = max(self.next_frame_time + self.interval,
+                                       time.time() - self.interval)
+
+        # Keep reading the current video, if any.
+        if self.video is not None:
+            if self.video.grab():
+                return True
+            self.video.release()
+            self.video = None
+
+        # Otherwise, move to the next file.
+        for _ in range(len(self.files)):
+            self.position = (self.position + 1) % len(self.files)
+            path = self.files[self.position]
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                self.image_file = path
+                return True
+
+            video = cv2.VideoCapture(path)
+            if video.isOpened() and video.grab():
+                self.image_file = None
+                self.video = video
+                return True
+            self.logger.error("Can't read video %s", path)
+
+        return False
+
+    def retrieve(self, buffer=None):
+        if self.video is not None:
+            (ok, image) = self.video.retrieve(buffer)
+        else:
+            image = cv2.imread(self.image_file, cv2.IMREAD_COLOR)
+            ok = image is not None
+        if not ok:
+            return (False, None)
+
+        if image.shape[:2] != (self.height, self.width):
+            image = cv2.resize(image, (self.width, self.height))
+        if buffer is not None and buffer.shape == image.shape and \
+                image is not buffer:
+            buffer[...] = image
+            image = buffer
+        return (True, image)
+
+    def set_frame_rate(self, fps):
+        self.interval = 1 / fps
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+            self.video = None
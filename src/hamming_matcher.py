@@ -0,0 +1,91 @@
+from __future__ import division
+
+import numpy as np
+
+# Upper bound of the size of the temporary arrays we create while computing
+# distances, so that we can match the whole database at once without running
+# out of memory. Half of it goes to the unpacked bits of the train features,
+# the other half to the unpacked bits of the query features and the block of
+# distances between them.
+MAX_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+#
+# This class matches binary features (ORB, AKAZE) using NumPy only.
+#
+# For a chunk of query features at a time, it computes the full matrix of
+# Hamming distances to the train features and extracts the two smallest
+# distances of every row. Results are returned as arrays, so the ratio test
+# can be applied to the whole database at once instead of walking lists of
+# cv2.DMatch objects.
+#
+# Rather than XOR-ing features and counting the bits that are set, features
+# are unpacked into vectors of 0s and 1s, so that the distance between a and b
+# is |a| + |b| - 2 * a.b: the whole matrix then comes from a single matrix
+# product, which NumPy hands to BLAS. All the values involved are small
+# integers, so the float32 results are exact.
+#
+# Unpacked features are 32 times larger than packed ones, so if the train
+# features don't fit in the budget, they are unpacked a chunk at a time too,
+# and the two nearest rows of every chunk are merged with the ones found so
+# far.
+#
+class HammingMatcher(object):
+    # For every row of `query`, find the two nearest rows of `train`. Returns
+    # a tuple of arrays (best train index, best distance, second best
+    # distance). `train` must contain at least two rows.
+    def knn2(self, query, train):
+        indices = np.zeros(len(query), dtype=np.intp)
+        best = np.full(len(query), np.inf, dtype=np.float32)
+        second = np.full(len(query), np.inf, dtype=np.float32)
+
+        bits_bytes = 4 * 8 * np.asarray(train).shape[1]
+        train_chunk = max(2, MAX_CHUNK_BYTES // 2 // bits_bytes)
+        for train_start in range(0, len(train), train_chunk):
+            (train_bits, train_counts) = self._unpack(
+                train[train_start:train_start + train_chunk])
+
+            # Every query row takes a row of distances and a row of unpacked
+            # bits.
+            row_bytes = 4 * len(train_bits) + bits_bytes
+            chunk = max(1, MAX_CHUNK_BYTES // 2 // row_bytes)
+            for start in range(0, len(query), chunk):
+                (query_bits, query_counts) = self._unpack(
+                    query[start:start + chunk])
+                block = query_bits.dot(train_bits.T)
+                block *= -2
+                block += query_counts[:, np.newaxis]
+                block += train_counts[np.newaxis, :]
+
+                rows = slice(start, start + len(block))
+                self._merge(block, train_start, indices[rows], best[rows],
+                            second[rows])
+
+        return (indices, best, second)
+
+    # Merge the two nearest rows of a block of distances, whose first column
+    # is row `offset` of the train features, into `indices`, `best` and
+    # `second`, in place. On ties, the first row wins, as with np.argmin().
+    @staticmethod
+    def _merge(block, offset, indices, best, second):
+        block_indices = np.argmin(block, axis=1)
+        if block.shape[1] >= 2:
+            nearest = np.partition(block, 1, axis=1)
+            (block_best, block_second) = (nearest[:, 0], nearest[:, 1])
+        else:
+            block_best = block[:, 0]
+            block_second = np.full(len(block), np.inf, dtype=np.float32)
+
+        better = block_best < best
+        second[:] = np.where(better, np.minimum(best, block_second),
+                             np.minimum(second, block_best))
+        indices[better] = block_indices[better] + offset
+        best[better] = block_best[better]
+
+    # Unpack binary features into float32 vectors of 0s and 1s, and count the
+    # bits that are set in every feature.
+    @staticmethod
+    def _unpack(features):
+        bits = np.unpackbits(np.asarray(features, dtype=np.uint8),
+                             axis=1).astype(np.float32)
+        return (bits, bits.sum(axis=1))
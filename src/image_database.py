@@ -1,10 +1,21 @@
 from __future__ import division
 
 import logging
+import shutil
 import time
 import os
+import numpy as np
 
-from image_description import ImageDescription
+import instrumentation
+from ann_index import AnnIndex
+from descriptor_index import DescriptorIndex, LazyItems
+from image_description import ImageDescription, color_histogram_from_file
+from item_store import MANIFEST_FILE, ItemStore
+from matching_executor import MatchingExecutor
+
+# Temporary directory, in the database directory, where items are migrated to
+# the packed item store.
+MIGRATION_DIR = ".migration"
 
 
 class ImageDatabase(object):
@@ -18,46 +29,156 @@ class ImageDatabase(object):
         # ImageDescription class.
         ImageDescription.init(options)
 
-        if os.path.isdir(self.root):
-            directories = ["{}/{}".format(self.root, identifier) for
-                           identifier in os.listdir(self.root)]
-            self.items = [ImageDescription.from_directory(directory) for
-                          directory in directories]
+        # Features and histograms of all items are kept in a packed store,
+        # the directory of every item only contains its image and audio.
+        if not ItemStore.exists(self.root) and os.path.isdir(self.root):
+            self._migrate()
+        self.store = ItemStore(self.root)
+        if not self.store.masked_histograms:
+            self._mask_histograms()
+
+        # Items are only loaded from the store when they are part of the
+        # result of a match. The list is shared with the index, which appends
+        # new items to it.
+        self.items = LazyItems(len(self.store), self._load_item)
+        counts = self.store.items['count']
+
+        # Matching can be spread over several processes, except with the FLANN
+        # matcher which doesn't match every feature anyway.
+        self.executor = None
+        if options.matching_workers > 1 and \
+                options.matching_matcher != 'flann':
+            self.executor = MatchingExecutor(options.matching_workers)
+
+        # All the features of the database, stacked so that we can match a
+        # new image against every item at once. With the FLANN matcher, we
+        # also maintain an approximate nearest neighbour index over them.
+        if options.matching_matcher == 'flann':
+            self.index = AnnIndex(self.root, self.items, self.store.features,
+                                  options.matching_histogram_shortlist,
+                                  options.matching_flann_rebuild_threshold,
+                                  counts, self.store.histograms)
         else:
-            self.items = []
+            self.index = DescriptorIndex(self.items, self.store.features,
+                                         options.matching_histogram_shortlist,
+                                         self.executor, counts,
+                                         self.store.histograms)
+
+        # Workers are forked now, before the other threads of the application
+        # are started, see MatchingExecutor.
+        if self.executor is not None:
+            self.executor.start(self.index)
 
         self.logger.debug("Loaded database in %ss", time.time() - start)
 
-    # Given an image and an audio label for it, this method does feature
-    # detection on the image, creates a new ImageDescription object,
-    # persists the item to disk and returns the ImageDescription object
+    # Given an image (an ObjectFrame or a BGRA image) and an audio label for
+    # it, this method does feature detection on the image, creates a new
+    # ImageDescription object, persists the item to disk and returns the
+    # ImageDescription object
     def add(self, image_data, audio_data, description=None):
         # We'll never add more than one image per second, so use a timestamp id.
-        dir_name = "{}/{}".format(self.root, time.strftime("%Y%m%dT%H%M%S"))
+        identifier = time.strftime("%Y%m%dT%H%M%S")
+        dir_name = "{}/{}".format(self.root, identifier)
 
         if description is None:
             description = ImageDescription.from_image(image_data)
         description.save(dir_name, audio_data, image_data)
-        self.items.append(description)
+        self.store.append(identifier, description.features,
+                          description.histogram, description.keypoints)
+        self.index.add(description, self.store.features)
 
         self.logger.debug("Image with %s features was added to the database",
                           len(description.features))
 
         return description
 
-    # Match the specified image against the database of images. The return value
-    # is an array containing zero or more (score, image_desc) tuples.
-    def match(self, image_data):
+    def _load_item(self, index):
+        (identifier, features, histogram, keypoints) = self.store.get(index)
+        return ImageDescription("{}/{}".format(self.root, identifier),
+                                features, histogram, keypoints)
+
+    # One-time migration from the original layout, where the features of every
+    # item were saved in a data.npz file in the directory of the item. The
+    # data.npz files are left untouched but are not used anymore.
+    #
+    # The store is built in a temporary directory and only moved into place
+    # once every item was migrated, the manifest last: if we are interrupted,
+    # the migration starts over on the next start instead of leaving a
+    # partial store behind.
+    def _migrate(self):
+        start = time.time()
+        identifiers = sorted(
+            identifier for identifier in os.listdir(self.root)
+            if os.path.isfile("{}/{}/data.npz".format(self.root, identifier)))
+        if not identifiers:
+            return
+
+        migration_dir = os.path.join(self.root, MIGRATION_DIR)
+        if os.path.isdir(migration_dir):
+            shutil.rmtree(migration_dir)
+
+        store = ItemStore(migration_dir)
+        for identifier in identifiers:
+            item = ImageDescription.from_directory(
+                "{}/{}".format(self.root, identifier))
+            histogram = color_histogram_from_file(item.image_filename())
+            if histogram is None:
+                histogram = item.histogram
+            store.append(identifier, item.features, histogram)
+        del store
+
+        names = sorted(os.listdir(migration_dir), key=lambda name:
+                       name == MANIFEST_FILE)
+        for name in names:
+            os.rename(os.path.join(migration_dir, name),
+                      os.path.join(self.root, name))
+        os.rmdir(migration_dir)
+
+        self.logger.info("Migrated %s items to the packed item store in %ss",
+                         len(identifiers), time.time() - start)
+
+    # One-time update of stores whose histograms were computed over whole
+    # frames: histograms of new items are computed under the mask of the
+    # object, so recompute the ones of existing items from their image, whose
+    # alpha channel is the mask. Items without an image keep their histogram.
+    def _mask_histograms(self):
+        start = time.time()
+        histograms = np.array(self.store.histograms)
+        for index in range(len(self.store)):
+            (identifier, _, _, _) = self.store.get(index)
+            histogram = color_histogram_from_file(
+                "{}/{}/image.png".format(self.root, identifier))
+            if histogram is not None:
+                histograms[index] = histogram
+
+        self.store.replace_histograms(histograms)
+        self.logger.info("Recomputed the histograms of %s items in %ss",
+                         len(self.store), time.time() - start)
+
+    # Match the specified image (an ObjectFrame or a BGRA image) against the
+    # database of images. The return value is an array containing zero or more
+    # (score, image_desc) tuples. If the description of the image was already
+    # extracted, it can be specified.
+    def match(self, image_data, target=None):
         start = time.time()
-        target = ImageDescription.from_image(image_data)
+        if target is None:
+            target = ImageDescription.from_image(image_data)
 
         self.logger.debug("Image to find a match for has %s features.",
                           len(target.features))
 
-        scores = [(target.compare_to(item), item) for item in self.items]
-        scores.sort(key=lambda s: s[0], reverse=True)
+        with instrumentation.span('match'):
+            scores = self.index.match(target)
+        with instrumentation.span('rank'):
+            scores = self.rank(scores)
 
         self.logger.debug("Matched against %s images in %ss", len(self.items),
                           time.time() - start)
 
         return scores
+
+    # Sort a list of (score, image_desc) tuples, best match first.
+    @staticmethod
+    def rank(scores):
+        scores.sort(key=lambda s: s[0], reverse=True)
+        return scores
@@ -1,29 +1,132 @@
 from __future__ import division
 
+import math
 import os
 import time
 import logging
+import threading
 import numpy as np
 import cv2
 import audioutils
+from hamming_matcher import HammingMatcher
+from item_store import KEYPOINT_WIDTH
+from object_frame import ObjectFrame
 
 FLANN_INDEX_KDTREE = 1
 FLANN_INDEX_LSH = 6
 
 # These variables specify how we extract and match features from an image
 # They're initialized by ImageDescription.init()
-feature_extractor = None
+feature_extractor_factory = None
 feature_matcher = None
+feature_norm = None
+flann_params = None
 ratio_test_k = None
 histogram_weight = None
 minimum_keypoints = None
 logger = None
 
+# Feature detectors can't be shared between threads, so every thread that
+# extracts features gets its own, see get_feature_extractor().
+_thread_local = threading.local()
+
 # This exception is raised if we can't find enough features in an image
 class TooFewFeaturesException(Exception):
     pass
 
 
+# Returns the feature detector of the current thread.
+def get_feature_extractor():
+    (factory, extractor) = getattr(_thread_local, 'feature_extractor',
+                                   (None, None))
+    if factory is not feature_extractor_factory:
+        extractor = feature_extractor_factory()
+        _thread_local.feature_extractor = (feature_extractor_factory,
+                                           extractor)
+    return extractor
+
+
+# Features are only extracted around the mask of the object. Keep a margin
+# around it, as detectors ignore keypoints that are too close to the border
+# of the image. This is the margin used for detectors whose border can't be
+# derived from their settings, see roi_padding().
+ROI_PADDING = 32
+
+
+# Returns the margin to keep around the object for the specified detector.
+# ORB ignores keypoints within `edgeThreshold` pixels of the border of every
+# level of its pyramid, which is about 111 pixels of the frame at the coarsest
+# level with the default settings.
+def roi_padding(detector):
+    if isinstance(detector, cv2.ORB):
+        return int(math.ceil(detector.getEdgeThreshold() *
+                             detector.getScaleFactor() **
+                             (detector.getNLevels() - 1)))
+    return ROI_PADDING
+
+
+def keypoints_to_array(keypoints):
+    return np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave)
+                     for k in keypoints],
+                    dtype=np.float32).reshape(-1, KEYPOINT_WIDTH)
+
+
+def keypoints_from_array(array):
+    return [cv2.KeyPoint(float(x), float(y), float(size), float(angle),
+                         float(response), int(octave))
+            for (x, y, size, angle, response, octave) in array]
+
+
+# Returns the color histogram of the object of an ObjectFrame, i.e. of the
+# pixels under its mask.
+def color_histogram(image):
+    histogram = cv2.calcHist([image.frame], [0, 1, 2], image.mask,
+                             [8, 8, 8], [0, 256, 0, 256, 0, 256])
+    return cv2.normalize(histogram, histogram).flatten()
+
+
+# Returns the color histogram of the object in an image saved by
+# ImageDescription.save(), with the mask as alpha channel, or None if the
+# image can't be read.
+def color_histogram_from_file(filename):
+    if not os.path.isfile(filename):
+        return None
+    image = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+    if image is None or image.ndim != 3:
+        return None
+    return color_histogram(ObjectFrame.wrap(image))
+
+
+# Match every row of `query` against the rows of `train` and apply the ratio
+# test: if the best match is significantly better than the second best match
+# then we consider it to be a good match. Note that the absolute distance of
+# the matches does not matter just their relative amounts.
+# The return value is a tuple of arrays with one entry per row of `query`:
+# whether the row has a good match, the index of its best match in `train`
+# and the distance to it.
+def ratio_test(query, train):
+    good = np.zeros(len(query), dtype=bool)
+    indices = np.full(len(query), -1, dtype=np.intp)
+    distances = np.full(len(query), np.inf, dtype=np.float32)
+    if len(query) == 0 or len(train) == 0:
+        return (good, indices, distances)
+
+    if isinstance(feature_matcher, HammingMatcher):
+        if len(train) < 2:
+            return (good, indices, distances)
+        (indices, distance1, distance2) = feature_matcher.knn2(query, train)
+        return (distance1 < ratio_test_k * distance2, indices, distance1)
+
+    for match in feature_matcher.knnMatch(query, train, k=2):
+        if len(match) == 2 and \
+                match[0].distance < ratio_test_k * match[1].distance:
+            good[match[0].queryIdx] = True
+            indices[match[0].queryIdx] = match[0].trainIdx
+            distances[match[0].queryIdx] = match[0].distance
+
+    return (good, indices, distances)
+
+
 class ImageDescription(object):
     feature_extractor = None
     feature_matcher = None
@@ -36,37 +139,47 @@ class ImageDescription(object):
     @staticmethod
     def init(options):
         if options.matching_detector == 'orb':
-            detector = cv2.ORB_create(
+            create_detector = lambda: cv2.ORB_create(
                 nfeatures=options.matching_orb_n_features)
             norm = cv2.NORM_HAMMING
         elif options.matching_detector == 'akaze':
-            detector = cv2.AKAZE_create(
+            create_detector = lambda: cv2.AKAZE_create(
                 descriptor_channels=options.matching_akaze_n_channels)
             norm = cv2.NORM_HAMMING
         else:
-            detector = cv2.xfeatures2d.SURF_create(
+            create_detector = lambda: cv2.xfeatures2d.SURF_create(
                 hessianThreshold=options.matching_surf_threshold)
             norm = cv2.NORM_L2
 
+        params = None
         if options.matching_matcher == 'brute-force':
             # Create Brute Force matcher.
             matcher = cv2.BFMatcher(norm)
+        elif options.matching_matcher == 'numpy-hamming':
+            if norm != cv2.NORM_HAMMING:
+                raise ValueError("The numpy-hamming matcher requires a binary "
+                                 "feature detector (orb or akaze)")
+            matcher = HammingMatcher()
         else:
             if norm == cv2.NORM_HAMMING:
-                flann_params = dict(algorithm=FLANN_INDEX_LSH,
-                                    table_number=6,
-                                    key_size=12,
-                                    multi_probe_level=1)
+                params = dict(algorithm=FLANN_INDEX_LSH,
+                              table_number=6,
+                              key_size=12,
+                              multi_probe_level=1)
             else:
-                flann_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+                params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
 
             # Create FLANN matcher.
-            matcher = cv2.FlannBasedMatcher(flann_params, {})
+            matcher = cv2.FlannBasedMatcher(params, {})
 
-        global feature_extractor
-        feature_extractor = detector
+        global feature_extractor_factory
+        feature_extractor_factory = create_detector
         global feature_matcher
         feature_matcher = matcher
+        global feature_norm
+        feature_norm = norm
+        global flann_params
+        flann_params = params
         global ratio_test_k
         ratio_test_k = options.matching_ratio_test_k
         global histogram_weight
@@ -77,13 +190,24 @@ class ImageDescription(object):
         logger = logging.getLogger(__name__)
 
     # Private constructor. Use one of the factory functions below
-    def __init__(self, dirname, features, histogram):
+    # `keypoints` is an array with one row per feature, see
+    # keypoints_to_array(). Its rows are NaN if keypoints are unknown, which
+    # is the case for items registered before they were persisted.
+    def __init__(self, dirname, features, histogram, keypoints=None):
         self.dirname = dirname
         self.features = features
         self.histogram = histogram
+        self.keypoints = keypoints
+
+        # When this describes a scene, this holds the good matches found by
+        # ImageDatabase.match() for every stored item, as a tuple of arrays
+        # (indices of the item features, indices of the scene features,
+        # distances).
+        self.good_matches = {}
 
     # Factory function that returns an ImageDescription read from the specified
-    # directory.
+    # directory. This is only used to migrate databases created before the
+    # ItemStore, which now holds the features of all items.
     @staticmethod
     def from_directory(dirname):
         datafile = "{}/{}".format(dirname, "data.npz")
@@ -93,37 +217,44 @@ class ImageDescription(object):
                                     data['histogram'])
 
     # Factory function that returns an ImageDescription created from the
-    # specified image data. The returned object does not have a dirname
-    # or any associated audio data until it is saved with the write() method
+    # specified image data, an ObjectFrame or a BGRA image. The returned object
+    # does not have a dirname or any associated audio data until it is saved
+    # with the write() method
     @staticmethod
     def from_image(image_data):
-        # Extract all possible keypoints from the frame.
-        grayscale = cv2.cvtColor(image_data, cv2.COLOR_BGR2GRAY)
-        mask = cv2.split(image_data)[3]
-        (keypoints, features) = feature_extractor.detectAndCompute(grayscale,
-                                                                   mask)
+        image = ObjectFrame.wrap(image_data)
+
+        # Extract all possible keypoints from the part of the frame that
+        # contains the object.
+        extractor = get_feature_extractor()
+        box = image.bounding_box(roi_padding(extractor))
+        if box[2] == 0 or box[3] == 0:
+            raise TooFewFeaturesException()
+        (grayscale, mask) = image.crop(box)
+        (keypoints, features) = extractor.detectAndCompute(grayscale, mask)
 
         if len(keypoints) < minimum_keypoints:
             raise TooFewFeaturesException()
 
-        # Calculate color histogram.
-        histogram = cv2.calcHist([image_data], [0, 1, 2], None,
-                                 [8, 8, 8], [0, 256, 0, 256, 0, 256])
-        histogram = cv2.normalize(histogram, histogram).flatten()
+        # Keypoints are relative to the cropped frame, move them back to
+        # frame coordinates.
+        keypoints = keypoints_to_array(keypoints)
+        keypoints[:, 0] += box[0]
+        keypoints[:, 1] += box[1]
 
-        return ImageDescription(None, features, histogram)
+        return ImageDescription(None, features, color_histogram(image),
+                                keypoints)
 
-    # This method saves the item description to the specified directory.
-    # If the image data and audio data are specified, they are also saved
+    # This method creates the directory of the item and saves the image data
+    # and audio data there, if they are specified. Features and histogram are
+    # persisted separately, by the ItemStore of the database.
     def save(self, dirname, audio_data=None, image_data=None):
         self.dirname = dirname
         os.makedirs(dirname)
 
-        datafile = "{}/{}".format(dirname, "data.npz")
-        np.savez(datafile, features=self.features, histogram=self.histogram)
-
         if image_data is not None:
-            cv2.imwrite("{}/{}".format(dirname, "image.png"), image_data)
+            cv2.imwrite("{}/{}".format(dirname, "image.png"),
+                        ObjectFrame.wrap(image_data).to_bgra())
 
         if audio_data is not None:
             audioutils.savefile("{}/{}".format(dirname, "audio.wav"),
@@ -155,22 +286,11 @@ class ImageDescription(object):
         # and the scene's features.
         # The order of the first two arguments here should match the
         # order below in draw_match.
-        matches = feature_matcher.knnMatch(other.features, self.features, k=2)
-
-        if len(matches) == 0:
+        if len(other.features) == 0 or len(self.features) == 0:
             return 0
 
-        # Apply ratio test: if the best match is significantly better than the
-        # second best match then we consider it to be a good match.
-        # Note that the absolute distance of the matches does not matter just
-        # their relative amounts.
-        good_matches = 0
-        for match in matches:
-            if len(match) == 2:
-                distance1 = match[0].distance
-                distance2 = match[1].distance
-                if distance1 < ratio_test_k * distance2:
-                    good_matches += 1
+        good_matches = np.count_nonzero(ratio_test(other.features,
+                                                   self.features)[0])
 
         # If the two images have similar numbers of keypoints this number will
         # be high and will increase the score.
@@ -179,7 +299,7 @@ class ImageDescription(object):
 
         # If most of the feature matches are good ones this ratio will be high
         # and will increase the score.
-        good_match_ratio = good_matches / len(matches)
+        good_match_ratio = good_matches / len(other.features)
 
         # Both of the numbers above are between 0 and 1. We take their product
         # and multiply by 100 to create a score between 0 and 100. Kind of a
@@ -195,35 +315,50 @@ class ImageDescription(object):
 
         logger.debug("Comparison has been made in %ss (matches: %s, "
                      "good matches: %s, score: %s)", time.time() - start,
-                     len(matches), good_matches, score)
+                     len(other.features), good_matches, score)
 
         return score
 
-    # TODO: We should not recalculate features once again here, we should reuse
-    # ones that were produced during matching.
-    def draw_match(self, scene):
+    # Draw the good matches between this stored item and a scene. `target` is
+    # the description of the scene that was matched against the database, we
+    # reuse its keypoints and the good matches that were found then.
+    def draw_match(self, scene, target):
         item = cv2.imread(self.image_filename())
-        gray_item = cv2.cvtColor(item, cv2.COLOR_BGRA2GRAY)
-        item_keypoints, item_features = feature_extractor.detectAndCompute(
-            gray_item, None)
-
-        gray_scene = cv2.cvtColor(scene, cv2.COLOR_BGRA2GRAY)
-        scene_keypoints, scene_features = feature_extractor.detectAndCompute(
-            gray_scene, None)
-
-        matches = feature_matcher.knnMatch(item_features, scene_features, k=2)
-
-        good_matches = []
-        for match in matches:
-            if len(match) == 2:
-                distance1 = match[0].distance
-                distance2 = match[1].distance
-                if distance1 < ratio_test_k * distance2:
-                    good_matches.append(match[0])
-
-        good_matches = sorted(good_matches, key=lambda x: x.distance)
+        scene = ObjectFrame.wrap(scene)
+
+        if self.keypoints is not None and \
+                not np.isnan(self.keypoints).any():
+            item_keypoints = self.keypoints
+            scene_keypoints = target.keypoints
+            empty = np.zeros(0, dtype=np.intp)
+            (item_indices, scene_indices, distances) = \
+                target.good_matches.get(self, (empty, empty, empty))
+        else:
+            # Keypoints of this item are unknown, we need to detect features
+            # once again on both images.
+            extractor = get_feature_extractor()
+            gray_item = cv2.cvtColor(item, cv2.COLOR_BGRA2GRAY)
+            (item_keypoints, item_features) = extractor.detectAndCompute(
+                gray_item, None)
+            (scene_keypoints, scene_features) = extractor.detectAndCompute(
+                scene.grayscale, None)
+
+            (good, indices, distances) = ratio_test(item_features,
+                                                    scene_features)
+            item_indices = np.flatnonzero(good)
+            scene_indices = indices[good]
+            distances = distances[good]
+            item_keypoints = keypoints_to_array(item_keypoints)
+            scene_keypoints = keypoints_to_array(scene_keypoints)
 
         # Take top 25 only.
-        match_image = cv2.drawMatches(item, item_keypoints, scene,
-                                      scene_keypoints, good_matches[:25], None)
+        good_matches = [cv2.DMatch(int(item_indices[i]), int(scene_indices[i]),
+                                   float(distances[i]))
+                        for i in np.argsort(distances)[:25]]
+
+        match_image = cv2.drawMatches(item,
+                                      keypoints_from_array(item_keypoints),
+                                      scene.frame,
+                                      keypoints_from_array(scene_keypoints),
+                                      good_matches, None)
         return match_image
@@ -0,0 +1,161 @@
+from __future__ import division
+
+import json
+import logging
+import os
+import time
+from collections import deque
+from threading import Lock, Thread
+from timeit import default_timer as timer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the buckets of latency histograms, in seconds.
+BUCKETS = [.001, .002, .005, .01, .02, .05, .1, .2, .5, 1, 2, 5, 10,
+           float('inf')]
+
+# Number of recent durations we keep for every stage.
+WINDOW = 1000
+
+PERCENTILES = [50, 90, 99]
+
+_lock = Lock()
+_stages = {}
+
+
+#
+# This class accumulates the durations of a stage of the pipeline. Only the
+# last WINDOW durations are kept, so statistics reflect recent behaviour.
+#
+class Stage(object):
+    def __init__(self, name):
+        self.name = name
+        self.durations = deque(maxlen=WINDOW)
+        self.count = 0
+
+    def add(self, duration):
+        self.durations.append(duration)
+        self.count += 1
+
+    # Returns statistics over the recent durations: total number of spans,
+    # number of recent ones, mean, percentiles, max and a histogram with the
+    # number of recent durations in each of BUCKETS.
+    def summary(self):
+        durations = sorted(self.durations)
+        stats = {'count': self.count, 'recent': len(durations)}
+        if not durations:
+            return stats
+
+        stats['mean'] = sum(durations) / len(durations)
+        stats['max'] = durations[-1]
+        for percentile in PERCENTILES:
+            index = min(len(durations) - 1,
+                        int(len(durations) * percentile / 100))
+            stats['p{}'.format(percentile)] = durations[index]
+
+        histogram = [0] * len(BUCKETS)
+        bucket = 0
+        for duration in durations:
+            while duration > BUCKETS[bucket]:
+                bucket += 1
+            histogram[bucket] += 1
+        stats['histogram'] = histogram
+        return stats
+
+
+#
+# This class times a named stage of the pipeline, see span().
+#
+class Span(object):
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+        self.duration = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def start(self):
+        self.started = timer()
+        return self
+
+    def stop(self):
+        self.duration = timer() - self.started
+        record(self.name, self.duration)
+
+
+# Returns a Span that times the named stage of the pipeline, use it with
+# `with`:
+#
+#     with span('match'):
+#         ...
+#
+# The duration is recorded when the block exits, even with an exception, and
+# remains available as the `duration` attribute of the span. Spans can also
+# be started and stopped explicitly with start() and stop().
+def span(name):
+    return Span(name)
+
+
+# Record the duration of a stage, in seconds.
+def record(name, duration):
+    with _lock:
+        stage = _stages.get(name)
+        if stage is None:
+            stage = _stages[name] = Stage(name)
+        stage.add(duration)
+
+
+# Returns the statistics of every stage, indexed by stage name.
+def summary():
+    with _lock:
+        return dict((name, stage.summary()) for (name, stage) in
+                    _stages.items())
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+
+
+# Log the statistics of every stage and, if `path` is specified, write them
+# to this file as JSON.
+def dump(path=None):
+    stages = summary()
+    for name in sorted(stages):
+        stats = stages[name]
+        if not stats['recent']:
+            continue
+        logger.info("%s: %d spans, mean %.3fs, p50 %.3fs, p90 %.3fs, "
+                    "p99 %.3fs, max %.3fs", name, stats['count'],
+                    stats['mean'], stats['p50'], stats['p90'], stats['p99'],
+                    stats['max'])
+
+    if path:
+        # The last bucket of histograms has no upper bound, which JSON can't
+        # represent, so it is left out of the list of bounds.
+        with open(path + ".tmp", "w") as f:
+            json.dump({'time': time.time(), 'buckets': BUCKETS[:-1],
+                       'stages': stages}, f, indent=2, sort_keys=True)
+        # Replace the previous dump atomically.
+        os.rename(path + ".tmp", path)
+
+
+# Dump statistics every `interval` seconds in a background thread.
+def dump_periodically(interval, path=None):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(path)
+            except (IOError, OSError):
+                logger.exception("Can't dump timings.")
+
+    thread = Thread(name="instrumentation-thread", target=loop)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,286 @@
+from __future__ import division
+
+import json
+import logging
+import os
+import numpy as np
+
+MANIFEST_FILE = "manifest.json"
+ITEMS_FILE = "items.bin"
+FEATURES_FILE = "features.bin"
+HISTOGRAMS_FILE = "histograms.bin"
+KEYPOINTS_FILE = "keypoints.bin"
+
+# Keypoints are stored as rows of (x, y, size, angle, response, octave), see
+# image_description.keypoints_to_array() and keypoints_from_array().
+KEYPOINT_WIDTH = 6
+
+STORE_VERSION = 1
+
+# One record per item in ITEMS_FILE: the item identifier (its directory name)
+# and the range of rows it owns in FEATURES_FILE.
+ITEM_DTYPE = np.dtype([('id', 'S32'), ('offset', '<i8'), ('count', '<i8')])
+
+
+#
+# This class is an append-only packed store for the features, keypoints and
+# histograms of the items of the database. Instead of one data.npz file per
+# item, it keeps:
+#
+# - features.bin: the features of every item, stacked row after row;
+# - keypoints.bin: the keypoint of every feature, in the same order. Rows are
+#   NaN for items whose keypoints are unknown (items migrated from data.npz
+#   files, or stores created before keypoints were persisted);
+# - histograms.bin: one color histogram per item. Stores created before
+#   histograms were computed under the mask of the object contain histograms
+#   of whole frames, see `masked_histograms`;
+# - items.bin: one fixed-size record per item (identifier, offset, count);
+# - manifest.json: a small header describing the layout of the files above.
+#
+# All the binary files are opened with np.memmap, so opening the store does
+# not depend on the number of items, and the stacked features can be used
+# directly as the matrix of a DescriptorIndex.
+#
+# Records are appended to items.bin last, once the rest of the data of the
+# item reached the disk, so an item only becomes visible once all of its data
+# has been written. Anything written after the last complete record (e.g. if
+# we crashed in the middle of append()) is discarded when the store is opened,
+# as well as records whose data is missing.
+#
+class ItemStore(object):
+    def __init__(self, root):
+        self.logger = logging.getLogger(__name__)
+        self.root = root
+        self.header = None
+
+        self.items = np.zeros(0, dtype=ITEM_DTYPE)
+        self.features = None
+        self.histograms = None
+        self.keypoints = None
+
+        if self.exists(root):
+            with open(self._path(MANIFEST_FILE)) as f:
+                self.header = json.load(f)
+
+            if self.header.get('version') != STORE_VERSION:
+                raise ValueError("Unsupported item store version {} in "
+                                 "{}".format(self.header.get('version'),
+                                             root))
+
+            self._recover()
+            self._map()
+
+    # Returns True if there is a packed store in the specified directory.
+    @staticmethod
+    def exists(root):
+        return os.path.isfile(os.path.join(root, MANIFEST_FILE))
+
+    def __len__(self):
+        return len(self.items)
+
+    # True if histograms were computed under the mask of the object, False
+    # if they need to be recomputed with replace_histograms().
+    @property
+    def masked_histograms(self):
+        return self.header is None or \
+            self.header.get('masked_histograms', False)
+
+    # Replace the histograms of all the items, and mark them as masked.
+    def replace_histograms(self, histograms):
+        histograms = np.ascontiguousarray(histograms, dtype=np.float32)
+        assert histograms.shape == self.histograms.shape
+
+        path = self._path(HISTOGRAMS_FILE)
+        with open(path + ".tmp", "wb") as f:
+            f.write(histograms.tobytes())
+        os.rename(path + ".tmp", path)
+
+        self.header['masked_histograms'] = True
+        self._write_manifest()
+        self._map()
+
+    # Returns the (identifier, features, histogram, keypoints) of the item at
+    # `index`. These are views on the memory-mapped files.
+    def get(self, index):
+        record = self.items[index]
+        start = int(record['offset'])
+        end = start + int(record['count'])
+        return (record['id'].decode('ascii'),
+                self.features[start:end],
+                self.histograms[index],
+                self.keypoints[start:end])
+
+    # Append the features, histogram and keypoints of a new item to the store.
+    def append(self, identifier, features, histogram, keypoints=None):
+        features = np.ascontiguousarray(features)
+        histogram = np.ascontiguousarray(histogram, dtype=np.float32)
+        if keypoints is None:
+            keypoints = self._unknown_keypoints(len(features))
+        keypoints = np.ascontiguousarray(keypoints, dtype=np.float32)
+
+        if self.header is None:
+            self._create(features, histogram)
+        elif features.dtype.str != self.header['feature_dtype'] or \
+                features.shape[1:] != (self.header['feature_width'],):
+            raise ValueError("Features of type {} {} can't be stored along "
+                             "features of type {} {}; was the database "
+                             "created with another detector?".format(
+                                 features.dtype.str, features.shape[1:],
+                                 self.header['feature_dtype'],
+                                 (self.header['feature_width'],)))
+
+        offset = self.items['offset'][-1] + self.items['count'][-1] \
+            if len(self.items) > 0 else 0
+        record = np.array([(identifier.encode('ascii'), offset,
+                            len(features))], dtype=ITEM_DTYPE)
+
+        # Discard whatever a previous append that failed midway (e.g. because
+        # the disk was full) left behind, so that the new item's data starts
+        # where its record says it does.
+        self._truncate(len(self.items), int(offset))
+        self._write(FEATURES_FILE, features)
+        self._write(HISTOGRAMS_FILE, histogram)
+        self._write(KEYPOINTS_FILE, keypoints)
+        self._write(ITEMS_FILE, record)
+
+        self._map()
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    @staticmethod
+    def _unknown_keypoints(count):
+        return np.full((count, KEYPOINT_WIDTH), np.nan, dtype=np.float32)
+
+    # Write the header of a new store, using the first item we append to
+    # determine the type and the size of features.
+    def _create(self, features, histogram):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        self.header = {
+            'version': STORE_VERSION,
+            'feature_dtype': features.dtype.str,
+            'feature_width': features.shape[1],
+            'histogram_size': histogram.size,
+            'masked_histograms': True,
+        }
+        self._write_manifest()
+
+    # Write the manifest atomically, its presence means that the store
+    # exists.
+    def _write_manifest(self):
+        manifest = self._path(MANIFEST_FILE)
+        with open(manifest + ".tmp", "w") as f:
+            json.dump(self.header, f)
+        os.rename(manifest + ".tmp", manifest)
+
+    # Append an array to one of the files, and make sure that it reached the
+    # disk, so that data files are never behind the record of an item.
+    def _write(self, name, array):
+        with open(self._path(name), "ab") as f:
+            f.write(array.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Truncate all the files to the last complete item record. Appends are
+    # not atomic, so after a crash or a power cut the data files can be longer
+    # than the items imply (we were interrupted before the record was
+    # written), or shorter (the data was never flushed to the disk): trailing
+    # records whose data isn't fully on disk are discarded too. Keypoints
+    # that are missing, because the store was created before they were
+    # persisted, are marked as unknown.
+    def _recover(self):
+        feature_row_size = np.dtype(self.header['feature_dtype']).itemsize * \
+            self.header['feature_width']
+        histogram_size = np.dtype(np.float32).itemsize * \
+            self.header['histogram_size']
+        keypoint_row_size = np.dtype(np.float32).itemsize * KEYPOINT_WIDTH
+
+        n_items = self._size(ITEMS_FILE) // ITEM_DTYPE.itemsize
+        if n_items > 0:
+            items = np.memmap(self._path(ITEMS_FILE), dtype=ITEM_DTYPE,
+                              mode='r', shape=(n_items,))
+            ends = items['offset'] + items['count']
+            complete = (ends * feature_row_size <=
+                        self._size(FEATURES_FILE)) & \
+                (np.arange(1, n_items + 1) * histogram_size <=
+                 self._size(HISTOGRAMS_FILE))
+            if os.path.isfile(self._path(KEYPOINTS_FILE)):
+                complete &= ends * keypoint_row_size <= \
+                    self._size(KEYPOINTS_FILE)
+            if not complete.all():
+                lost = n_items - int(np.argmin(complete))
+                self.logger.warning("Discarding %s items whose data is "
+                                    "missing", lost)
+                n_items -= lost
+            n_rows = int(ends[n_items - 1]) if n_items > 0 else 0
+            del items
+        else:
+            n_rows = 0
+
+        self._truncate(n_items, n_rows)
+
+        known_keypoints = self._size(KEYPOINTS_FILE) // keypoint_row_size
+        if known_keypoints < n_rows:
+            with open(self._path(KEYPOINTS_FILE), "ab") as f:
+                f.truncate(known_keypoints * keypoint_row_size)
+            self._write(KEYPOINTS_FILE,
+                        self._unknown_keypoints(n_rows - known_keypoints))
+
+    # Truncate the files that are longer than `n_items` items, with `n_rows`
+    # features in total, imply.
+    def _truncate(self, n_items, n_rows):
+        feature_row_size = np.dtype(self.header['feature_dtype']).itemsize * \
+            self.header['feature_width']
+        histogram_size = np.dtype(np.float32).itemsize * \
+            self.header['histogram_size']
+        keypoint_row_size = np.dtype(np.float32).itemsize * KEYPOINT_WIDTH
+
+        for name, size in [(ITEMS_FILE, n_items * ITEM_DTYPE.itemsize),
+                           (FEATURES_FILE, n_rows * feature_row_size),
+                           (HISTOGRAMS_FILE, n_items * histogram_size),
+                           (KEYPOINTS_FILE, n_rows * keypoint_row_size)]:
+            if self._size(name) > size:
+                self.logger.warning("Discarding incomplete data at the end "
+                                    "of %s", name)
+                with open(self._path(name), "r+b") as f:
+                    f.truncate(size)
+
+    def _size(self, name):
+        path = self._path(name)
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+
+    # (Re)map the files of the store. np.memmap can't map empty files, so we
+    # use empty arrays until the first item is appended.
+    def _map(self):
+        feature_dtype = np.dtype(self.header['feature_dtype'])
+        feature_width = self.header['feature_width']
+        histogram_size = self.header['histogram_size']
+
+        n_items = self._size(ITEMS_FILE) // ITEM_DTYPE.itemsize
+        if n_items == 0:
+            self.items = np.zeros(0, dtype=ITEM_DTYPE)
+            self.features = np.zeros((0, feature_width), dtype=feature_dtype)
+            self.histograms = np.zeros((0, histogram_size), dtype=np.float32)
+            self.keypoints = self._unknown_keypoints(0)
+            return
+
+        self.items = np.memmap(self._path(ITEMS_FILE), dtype=ITEM_DTYPE,
+                               mode='r', shape=(n_items,))
+
+        n_rows = int(self.items['offset'][-1] + self.items['count'][-1])
+        if n_rows > 0:
+            self.features = np.memmap(self._path(FEATURES_FILE),
+                                      dtype=feature_dtype, mode='r',
+                                      shape=(n_rows, feature_width))
+            self.keypoints = np.memmap(self._path(KEYPOINTS_FILE),
+                                       dtype=np.float32, mode='r',
+                                       shape=(n_rows, KEYPOINT_WIDTH))
+        else:
+            self.features = np.zeros((0, feature_width), dtype=feature_dtype)
+            self.keypoints = self._unknown_keypoints(0)
+
+        self.histograms = np.memmap(self._path(HISTOGRAMS_FILE),
+                                    dtype=np.float32, mode='r',
+                                    shape=(n_items, histogram_size))
@@ -3,36 +3,50 @@ or compare with existing objects from the database.
 """
 from __future__ import print_function
 
+import glob
 import logging
 import os
+import signal
 import subprocess
 import sys
+import threading
 import time
+from collections import deque
 import cv2
 import numpy
 
 
 import config
 import audioutils
+import instrumentation
+from background import BackgroundModel, SubtractionStage
 from camera import Camera
+from frame_source import ReplaySource, VideoSource
 from eventloop import EventLoop
+from frame_processor import FrameProcessor
+from motion import StabilityDetector
+from object_frame import ObjectFrame
+from match_log import MatchLogWriter
 from image_database import ImageDatabase
-from image_description import ImageDescription, TooFewFeaturesException
 
 # Define base and sounds folder paths.
 BASE_PATH = os.path.dirname(__file__)
 SOUNDS_PATH = os.path.join(BASE_PATH, 'sounds')
 
-# Define some sounds that we will be playing.
-START_RECORDING_TONE = audioutils.makebeep(800, .2)
-STOP_RECORDING_TONE = audioutils.makebeep(400, .2)
-CHIRP = audioutils.makebeep(600, .05)
+# Define some sounds that we will be playing, as (frequency, duration) of
+# tones, see audioutils.tone().
+START_RECORDING_TONE = (800, .2)
+STOP_RECORDING_TONE = (400, .2)
+CHIRP = (600, .05)
 SHUTTER_TONE = None
 
 DEBUG = False
 
 db = None
 camera = None
+background_model = None
+frame_processor = None
+match_log = None
 options = config.get_config()
 
 logger = logging.getLogger(__name__)
@@ -74,21 +88,24 @@ def pick_only_accurate_matches(matches):
 def match_item(frames):
     matches = []
 
-    # Image with the larger number of matches.
-    image = None
+    # Image that produced `matches`, and its description.
+    matched_image = None
+    matched_description = None
 
-    # We'll take up to this many pictures in order to find match.
-    for image in frames:
+    # We'll take up to this many pictures in order to find match. Frames are
+    # matched as soon as their features are extracted.
+    for (image, description) in frame_processor.describe(frames):
         # FIXME: That's bad, we should check all frames we have before we fail.
-        try:
-            matches = db.match(image)
-        except TooFewFeaturesException:
+        if description is None:
             continue
-        else:
-            # Once we find first accurate match, let's stop trying to find more.
-            if len(matches) > 0 and matches[0][0] >= \
-                    options.matching_score_threshold:
-                break
+
+        matches = db.match(image, description)
+        (matched_image, matched_description) = (image, description)
+
+        # Once we find first accurate match, let's stop trying to find more.
+        if len(matches) > 0 and matches[0][0] >= \
+                options.matching_score_threshold:
+            break
 
     if len(matches) == 0:
         logger.info("Too few features.")
@@ -113,59 +130,34 @@ def match_item(frames):
             audioutils.playfile(match.audio_filename())
             time.sleep(0.2)
 
-    if options.log_path and len(matches) > 0:
-        start = time.time()
-
-        # Store both original photo and photo with keypoints.
-        file_id = time.strftime("%Y%m%dT%H%M%S")
-        filename = "{}/{}-match.png".format(options.log_path, file_id)
-        filename_original = "{}/{}.png".format(options.log_path, file_id)
-
-        (score, item) = matches[0]
-        match_image = item.draw_match(image)
-        cv2.putText(match_image, "Score: {}".format(score), (10, 25),
-                    cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255))
-        cv2.imwrite(filename, match_image)
-        cv2.imwrite(filename_original, image)
-        logger.debug("Match photo saved in %s", time.time() - start)
+    # Pictures of the match are rendered and saved in the background.
+    if match_log is not None and len(matches) > 0:
+        match_log.log(matched_image, matched_description, matches[0])
 
 
 def capture_moving_objects(expected_number_of_frames):
-    op_start = time.clock()
     background_subtractor = cv2.createBackgroundSubtractorKNN()
 
-    previous_frame = None
-    captured_frames = []
-    stable_captured_frames = 0
+    stability = StabilityDetector(options.motion_stability_factor,
+                                  options.motion_stability_duration)
     surface = options.video_width * options.video_height
     resample_factor = options.video_resample_factor
     expected_number_of_frames += options.motion_skip_frames
+    # We're running in limited memory, make sure that we're not keeping too
+    # many frames in memory.
+    captured_frames = deque(maxlen=expected_number_of_frames)
 
     # Capture images. We expect that the user is moving the object in front of
     # the camera. Continue filming until motion stabilizes.
-    while (len(captured_frames) < expected_number_of_frames
-           or
-           stable_captured_frames < options.motion_stability_duration):
-        frame = camera.capture()
-        captured_frames.append(frame)
-
-        # We're running in limited memory, make sure that we're not keeping too
-        # many frames in memory.
-        if len(captured_frames) > expected_number_of_frames:
-            captured_frames = captured_frames[1:]
-
-        # Check stability.
-        if previous_frame is not None:
-            diff = cv2.norm(previous_frame, frame)
-            if diff <= surface * options.motion_stability_factor:
-                # Ok, not too much movement between the last two images, we
-                # might be stabilizing.
-                stable_captured_frames += 1
-            else:
-                stable_captured_frames = 0
-
-        previous_frame = frame
-
+    with instrumentation.span('camera'):
+        while (len(captured_frames) < expected_number_of_frames
+               or
+               not stability.stable):
+            frame = camera.capture()
+            captured_frames.append(frame)
+            stability.update(frame)
+
+    background = instrumentation.span('background').start()
     object_frames = []
 
     # Now proceed with background subtraction.
@@ -214,15 +206,11 @@ def capture_moving_objects(expected_number_of_frames):
         bw_mask = cv2.resize(downsampled_bw_mask, (0, 0),
                              fx=1/resample_factor,
                              fy=1/resample_factor)
-        split_1, split_2, split_3 = cv2.split(frame)
-        object_frame = cv2.merge([split_1, split_2, split_3, bw_mask])
-        object_frames.append(object_frame)
+        object_frames.append(ObjectFrame(frame, bw_mask))
 
+    background.stop()
     logger.info("After background subtraction, I have %d objects.",
                 len(object_frames))
-
-    op_stop = time.clock()
-    logger.info("Image capture took %d s", (op_stop - op_start))
     return object_frames
 
 
@@ -230,11 +218,9 @@ def capture_everything():
     """Image acquisition strategy: just take a bunch of pictures, don't attempt
     to remove the background."""
 
-    captured_frames = []
-    while len(captured_frames) < options.matching_n_frames:
-        frame = camera.capture()
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
-        captured_frames.append(frame)
+    with instrumentation.span('camera'):
+        captured_frames = [ObjectFrame(frame) for frame in
+                           camera.capture_burst(options.matching_n_frames)]
 
     audioutils.playAsync(SHUTTER_TONE)
 
@@ -258,7 +244,8 @@ def capture_by_unhiding():
         audioutils.playfile(get_sound('register_step1.wav'))
 
         # First, capture the full image.
-        _full_image_for_capture_by_unhiding = camera.capture()
+        with instrumentation.span('camera'):
+            _full_image_for_capture_by_unhiding = camera.capture()
         audioutils.play(SHUTTER_TONE)
 
         audioutils.playfile(get_sound('register_step2.wav')) # Lasts ~4 seconds.
@@ -270,25 +257,17 @@ def capture_by_unhiding():
 
     full_image = _full_image_for_capture_by_unhiding
     _full_image_for_capture_by_unhiding = None
-    stable_captured_frames = 0
-    surface = options.video_width * options.video_height
+    stability = StabilityDetector(options.motion_stability_factor,
+                                  options.motion_stability_duration)
+    stability.reset(full_image)
 
-    previous_frame = full_image
     frame = None
-    while stable_captured_frames < options.motion_stability_duration:
-        frame = camera.capture()
-        diff = cv2.norm(previous_frame, frame)
-        previous_frame = frame
-
-        logger.debug("Frame difference is %d/%d", diff,
-                     surface * options.motion_stability_factor)
-
-        if diff <= surface * options.motion_stability_factor:
-            # Ok, not too much movement between the last two images, we
-            # might be stabilizing.
-            stable_captured_frames += 1
-        else:
-            stable_captured_frames = 0
+    with instrumentation.span('camera'):
+        while not stability.stable:
+            frame = camera.capture()
+            stability.update(frame)
+
+    background = instrumentation.span('background').start()
 
     # At this stage, `full_image` should contain the background + object
     # and `frame` should contain the background without the object.
@@ -347,8 +326,8 @@ def capture_by_unhiding():
                                   fy=1/resample_factor,
                                   interpolation=cv2.INTER_NEAREST)
 
-    split_1, split_2, split_3 = cv2.split(full_image)
-    object_frame = cv2.merge([split_1, split_2, split_3, denoised_bw_mask])
+    object_frame = ObjectFrame(full_image, denoised_bw_mask)
+    background.stop()
 
     audioutils.playAsync(SHUTTER_TONE)
 
@@ -356,7 +335,7 @@ def capture_by_unhiding():
     if DEBUG:
         cv2.imwrite("/tmp/full_image.png", full_image)
         cv2.imwrite("/tmp/frame.png", frame)
-        cv2.imwrite("/tmp/object.png", object_frame)
+        cv2.imwrite("/tmp/object.png", object_frame.to_bgra())
         cv2.imwrite("/tmp/noisy_mask.png", downsampled_noisy_mask)
         cv2.imwrite("/tmp/downsampled_denoised_bw_mask.png", downsampled_denoised_bw_mask)
         cv2.imwrite("/tmp/denoised_bw_mask.png", denoised_bw_mask)
@@ -369,110 +348,60 @@ def capture_by_subtracting():
     of the camera. Once the object has stopped moving, use background
     subtraction to remove the background."""
 
-    op_start = time.clock()
-    background_subtractor = cv2.createBackgroundSubtractorKNN()
-
-    previous_frame = None
-    captured_frames = []
-    stable_captured_frames = 0
-    surface = options.video_width * options.video_height
-    resample_factor = options.video_resample_factor
-    expected_number_of_frames = options.motion_skip_frames + \
-                                options.matching_n_frames
+    # Use the background model maintained by the camera thread if it is
+    # ready. Otherwise, start a new background subtractor, which needs a few
+    # frames before it produces anything usable.
+    if background_model is not None and background_model.ready:
+        subtract_background = background_model.apply
+        skip_frames = 0
+    else:
+        subtract_background = cv2.createBackgroundSubtractorKNN().apply
+        skip_frames = options.motion_skip_frames
+
+    captured_frames = 0
+    stability = StabilityDetector(options.motion_stability_factor,
+                                  options.motion_stability_duration)
+    expected_number_of_frames = skip_frames + options.matching_n_frames
+
+    # Background subtraction runs on a worker thread while we capture.
+    subtraction = SubtractionStage(subtract_background,
+                                   options.video_resample_factor,
+                                   options.motion_discard_small_polygons,
+                                   skip_frames,
+                                   options.matching_n_frames,
+                                   expected_number_of_frames)
 
     audioutils.playfile(get_sound('shake_it.wav'))
 
     # Capture images. We expect that the user is moving the object in front of
     # the camera. Continue filming until motion stabilizes.
-    while (len(captured_frames) < expected_number_of_frames
-           or
-           stable_captured_frames < options.motion_stability_duration):
-        frame = camera.capture()
-        captured_frames.append(frame)
-
-        # We're running in limited memory, make sure that we're not keeping too
-        # many frames in memory.
-        if len(captured_frames) > expected_number_of_frames:
-            captured_frames = captured_frames[1:]
-
-        # Check stability.
-        if previous_frame is not None:
-            diff = cv2.norm(previous_frame, frame)
-            if diff <= surface * options.motion_stability_factor:
-                # Ok, not too much movement between the last two images, we
-                # might be stabilizing.
-                stable_captured_frames += 1
-            else:
-                stable_captured_frames = 0
-
-        previous_frame = frame
-
-    audioutils.playAsync(SHUTTER_TONE)
+    try:
+        with instrumentation.span('camera'):
+            while (captured_frames < expected_number_of_frames
+                   or
+                   not stability.stable):
+                frame = camera.capture()
+                subtraction.push(frame)
+                captured_frames += 1
+                stability.update(frame)
+
+        audioutils.playAsync(SHUTTER_TONE)
+
+        # Most frames have already been processed while we were capturing.
+        with instrumentation.span('background'):
+            results = subtraction.finish()
+    finally:
+        subtraction.stop()
 
     object_frames = []
-
-    # Now proceed with background subtraction.
-    for idx, frame in enumerate(captured_frames):
-        downsampled_frame = cv2.resize(frame, (0, 0),
-                                       fx=resample_factor,
-                                       fy=resample_factor)
-        downsampled_subtraction = background_subtractor.apply(downsampled_frame)
-        _, downsampled_noisy_mask = cv2.threshold(downsampled_subtraction,
-                                                  200, 255, cv2.THRESH_BINARY)
-
-        # Experience shows that the background subtractor needs a few frames
-        # before it produces anything usable.
-        if idx < options.motion_skip_frames:
-            continue
-
-        # Ok, at this stage, the background subtraction should be bootstrapped.
-        # We can make use of `downsampled_noisy_mask`.
-        downsampled_height, downsampled_width = downsampled_noisy_mask.shape[:2]
-
-        # Approximate everything by polygons, removing the smallest polygons.
-        # This has the double effect of:
-        # - getting rid of all contours that are too small;
-        # - restoring missing pixels inside the moving object.
-        _, contours, _ = cv2.findContours(downsampled_noisy_mask,
-                                          cv2.RETR_EXTERNAL,
-                                          cv2.CHAIN_APPROX_NONE)
-
-        downsampled_bw_mask = numpy.zeros((downsampled_height,
-                                           downsampled_width),
-                                          numpy.uint8)
-        is_empty = True
-        for cnt in contours:
-            area = cv2.contourArea(cnt)
-            fraction = area / (resample_factor * resample_factor * surface)
-            if fraction > options.motion_discard_small_polygons:
-                is_empty = False
-                hull = cv2.convexHull(cnt)
-                cv2.fillPoly(downsampled_bw_mask, [hull], 255, 8)
-
-        if is_empty:
-            # This image isn't really useful, let's throw it away.
-            logger.info("Can't find any moving object on frame %d", idx)
-            continue
-
-        # Now that all the sophisticated computations are done, upsample the
-        # mask and use it to extract the object, with transparency.
-        bw_mask = cv2.resize(downsampled_bw_mask, (0, 0),
-                             fx=1/resample_factor,
-                             fy=1/resample_factor,
-                             interpolation=cv2.INTER_NEAREST)
-        split_1, split_2, split_3 = cv2.split(frame)
-        object_frame = cv2.merge([split_1, split_2, split_3, bw_mask])
+    for idx, object_frame in results:
         object_frames.append(object_frame)
 
         if DEBUG:
-            cv2.imwrite("/tmp/object-%d.png" % idx, object_frame)
+            cv2.imwrite("/tmp/object-%d.png" % idx, object_frame.to_bgra())
 
     logger.info("After background subtraction, I have %d objects.",
                 len(object_frames))
-
-    op_stop = time.clock()
-    logger.info("Image capture took %d s",
-                (op_stop - op_start))
     return object_frames
 
 
@@ -483,16 +412,15 @@ def record_new_item(frames):
     best_description = None
     best_image = None
 
-    for image in frames:
-        try:
-            description = ImageDescription.from_image(image)
-
-            if best_description is None or len(best_description.features) < \
-                    len(description.features):
-                best_description = description
-                best_image = image
-        except TooFewFeaturesException:
+    for (image, description) in frame_processor.describe(frames):
+        if description is None:
             logger.info("Too few features in the frame.")
+            continue
+
+        if best_description is None or len(best_description.features) < \
+                len(description.features):
+            best_description = description
+            best_image = image
 
     if best_description is None:
         audioutils.playfile(get_sound('nothing_recognized.wav'))
@@ -501,12 +429,15 @@ def record_new_item(frames):
     audio = None
     while audio is None:
         audioutils.playfile(get_sound('afterthetone.wav'))
-        audioutils.play(START_RECORDING_TONE)
+        audioutils.play(audioutils.tone(*START_RECORDING_TONE))
+        # Start recording when the tone ends, even if the microphone takes
+        # a moment to deliver samples.
         audio = audioutils.record(min_duration=2,
                                   max_duration=options.max_record_time,
                                   silence_threshold=options.silence_threshold,
-                                  silence_factor=options.silence_factor)
-        audioutils.play(STOP_RECORDING_TONE)
+                                  silence_factor=options.silence_factor,
+                                  since=time.time())
+        audioutils.play(audioutils.tone(*STOP_RECORDING_TONE))
         if len(audio) < 800:  # if we got less than 50ms of sound
             audio = None
             audioutils.playfile(get_sound('nosound.wav'))
@@ -521,32 +452,57 @@ def record_new_item(frames):
 def ready():
     global busy
     busy = False
-    audioutils.play(CHIRP)
+    audioutils.play(audioutils.tone(*CHIRP))
 
 
-def capture_frames_then(callback):
+def capture_frames_then(callback, interaction=None):
     global busy
     busy = True
 
-    if options.motion_background_removal_strategy == "keep-everything":
-        frames = capture_everything()
-    elif options.motion_background_removal_strategy == "now-you-see-me":
-        frames = capture_by_unhiding()
-    elif options.motion_background_removal_strategy == "moving-object":
-        frames = capture_by_subtracting()
-    else:
-        logger.exception("Unexpected capture strategy %s",
-                         options.motion_background_removal_strategy)
-        raise Exception
-
-    if isinstance(frames, list):
-        # `frames` actually contains frames
-        callback(frames)
-        eventloop.later(ready, 0.5)
-    else:
-        # `frames` is actually a delay before we should
-        # try again
-        eventloop.later(lambda: capture_frames_then(callback), frames)
+    # The interaction is timed from the button press to the answer, including
+    # the retries of the capture.
+    if interaction is None:
+        interaction = instrumentation.span('interaction').start()
+    retrying = False
+    try:
+        # Don't let the background model learn the object while we capture
+        # it.
+        if background_model is not None:
+            background_model.pause()
+        try:
+            with instrumentation.span('capture') as capture:
+                if options.motion_background_removal_strategy == \
+                        "keep-everything":
+                    frames = capture_everything()
+                elif options.motion_background_removal_strategy == \
+                        "now-you-see-me":
+                    frames = capture_by_unhiding()
+                elif options.motion_background_removal_strategy == \
+                        "moving-object":
+                    frames = capture_by_subtracting()
+                else:
+                    logger.exception(
+                        "Unexpected capture strategy %s",
+                        options.motion_background_removal_strategy)
+                    raise Exception
+        finally:
+            if background_model is not None:
+                background_model.resume()
+        logger.info("Image capture took %.2fs", capture.duration)
+
+        if isinstance(frames, list):
+            # `frames` actually contains frames
+            callback(frames)
+            eventloop.later(ready, 0.5)
+        else:
+            # `frames` is actually a delay before we should
+            # try again
+            eventloop.later(lambda: capture_frames_then(callback,
+                                                        interaction), frames)
+            retrying = True
+    finally:
+        if not retrying:
+            interaction.stop()
 
 
 def button_handler(event, pin):
@@ -565,6 +521,27 @@ def button_handler(event, pin):
         capture_frames_then(record_new_item)
 
 
+def get_timings_path():
+    if not options.log_path:
+        return None
+    return os.path.join(options.log_path, 'timings.json')
+
+
+# Log the latency statistics of every stage of the pipeline, and save them in
+# the log directory.
+def dump_timings():
+    instrumentation.dump(get_timings_path())
+
+
+# SIGUSR1 handler. Signal handlers run on the main thread, possibly while it
+# holds the instrumentation or logging locks, so the dump happens on another
+# thread.
+def dump_timings_on_signal(_signum, _frame):
+    thread = threading.Thread(name="dump-timings-thread", target=dump_timings)
+    thread.daemon = True
+    thread.start()
+
+
 def keyboard_handler(key=None):
     if busy:
         logger.debug('ignoring key %s', key)
@@ -574,11 +551,14 @@ def keyboard_handler(key=None):
         capture_frames_then(record_new_item)
     elif key == 'M' or key == 'm':
         capture_frames_then(match_item)
+    elif key == 'T' or key == 't':
+        dump_timings()
     elif key == 'Q' or key == 'q':
         sys.exit(0)
     else:
         print('Enter R to record a new item'
               ' or M to match an item'
+              ' or T to show timings'
               ' or Q to quit')
 
 
@@ -587,16 +567,37 @@ def main():
     global db
     db = ImageDatabase(options)
 
-    # Initialize the camera object we'll use to take pictures.
+    # Extract features of the captured frames concurrently.
+    global frame_processor
+    frame_processor = FrameProcessor(options.matching_extraction_threads)
+
+    # If requested, keep a model of the background up to date in the camera
+    # thread.
+    global background_model
+    if options.motion_background_removal_strategy == "moving-object" and \
+            options.motion_background_model_rate > 0:
+        background_model = BackgroundModel(
+            options.motion_background_model_rate,
+            options.video_resample_factor,
+            options.motion_skip_frames)
+
+    # Initialize the camera object we'll use to take pictures, either from
+    # a live video source or from recorded frames.
     global camera
-    camera = Camera(options.video_source,
-                    options.video_width,
-                    options.video_height,
-                    options.video_fps)
-
-    with open(get_sound('shutter.raw'), 'rb') as f:
-        global SHUTTER_TONE
-        SHUTTER_TONE = f.read()
+    if options.image_source:
+        source = ReplaySource(options.image_source,
+                              options.video_width,
+                              options.video_height,
+                              options.video_fps,
+                              realtime=options.image_source_pace == 'realtime')
+    else:
+        source = VideoSource(options.video_source,
+                             options.video_width,
+                             options.video_height,
+                             options.video_fps)
+    camera = Camera(source,
+                    standby_fps=options.video_standby_fps,
+                    background_model=background_model)
 
     # Set up the audio devices if they are configured
     if options.audio_out_device:
@@ -604,10 +605,35 @@ def main():
     if options.audio_in_device:
         audioutils.ALSA_MICROPHONE = options.audio_in_device
 
+    # Start the audio player and load all the prompts in memory, so that
+    # they play without delay.
+    audioutils.preload(glob.glob(os.path.join(SOUNDS_PATH, '*.wav')) +
+                       [get_sound('shutter.raw')])
+    global SHUTTER_TONE
+    SHUTTER_TONE = audioutils.load(get_sound('shutter.raw'))
+
+    if options.audio_preroll > 0:
+        audioutils.arm_microphone(options.audio_preroll)
+
     # If log path is set, make sure the corresponding directory exists.
     if options.log_path and not os.path.isdir(options.log_path):
         os.makedirs(options.log_path)
 
+    if options.log_path:
+        global match_log
+        match_log = MatchLogWriter(options.log_path,
+                                   options.log_image_format,
+                                   options.log_image_quality,
+                                   options.log_sample_rate)
+
+    # Latency statistics of the stages of the pipeline can be dumped
+    # periodically, and on demand with SIGUSR1.
+    if options.log_timings_interval > 0:
+        instrumentation.dump_periodically(options.log_timings_interval,
+                                          get_timings_path())
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, dump_timings_on_signal)
+
     # If --web-server was specified, run a web server in a separate process
     # to expose the files in that directory.
     # Note that we're using port 80, assuming we'll always run as root.
@@ -0,0 +1,104 @@
+from __future__ import division
+
+import logging
+import time
+from collections import deque
+from threading import Condition, Thread
+import cv2
+
+import instrumentation
+from object_frame import ObjectFrame
+
+
+#
+# This class writes diagnostic pictures of matches (the captured photo and a
+# picture of the matched keypoints) to the log directory. Rendering and
+# encoding pictures is slow on the device, so it happens in a background
+# thread instead of delaying the next interaction.
+#
+# Pending entries are kept in a bounded queue. If the writer can't keep up,
+# the oldest pending entry is dropped to make room for the new one.
+#
+# Only a fraction `sample_rate` of the matches is logged, e.g. with .25 we
+# log one match out of four.
+#
+class MatchLogWriter(object):
+    def __init__(self, path, image_format='png', quality=90, sample_rate=1.0,
+                 queue_size=4):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.sample_rate = sample_rate
+        self.sampling = 0.0
+
+        if image_format == 'jpeg':
+            self.extension = 'jpg'
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        else:
+            self.extension = 'png'
+            self.params = []
+
+        self.queue = deque(maxlen=queue_size)
+        self.condition = Condition()
+
+        # Counters, for diagnostics.
+        self.written = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.failed = 0
+
+        self.thread = Thread(name="match-log-thread", target=self._thread)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue a match for logging. `image` is the captured image, `target` its
+    # description and `match` the (score, item) tuple of the best match.
+    def log(self, image, target, match):
+        self.sampling += self.sample_rate
+        if self.sampling < 1:
+            self.skipped += 1
+            return
+        self.sampling -= 1
+
+        file_id = time.strftime("%Y%m%dT%H%M%S")
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+                self.logger.debug("Match log is full, dropping oldest entry "
+                                  "(%s dropped so far).", self.dropped)
+            self.queue.append((file_id, image, target, match))
+            self.condition.notify()
+
+    def _thread(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                entry = self.queue.popleft()
+
+            try:
+                with instrumentation.span('match_log'):
+                    self._write(*entry)
+            except Exception:  # pylint: disable=broad-except
+                # A bad entry must not stop the only writer thread.
+                self.failed += 1
+                self.logger.exception("Can't write match log (%s failed so "
+                                      "far).", self.failed)
+
+    def _write(self, file_id, image, target, match):
+        start = time.time()
+
+        # Store both original photo and photo with keypoints.
+        filename = "{}/{}-match.{}".format(self.path, file_id, self.extension)
+        filename_original = "{}/{}.{}".format(self.path, file_id,
+                                              self.extension)
+
+        (score, item) = match
+        match_image = item.draw_match(image, target)
+        cv2.putText(match_image, "Score: {}".format(score), (10, 25),
+                    cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255))
+        cv2.imwrite(filename, match_image, self.params)
+        cv2.imwrite(filename_original, ObjectFrame.wrap(image).to_bgra(),
+                    self.params)
+
+        self.written += 1
+        self.logger.debug("Match photo saved in %s", time.time() - start)
@@ -0,0 +1,115 @@
+from __future__ import division
+
+import logging
+import multiprocessing
+import signal
+import numpy as np
+import cv2
+
+# Workers must inherit the index from the parent process, which requires fork.
+try:
+    _context = multiprocessing.get_context('fork')
+except AttributeError:
+    # Python 2 always forks.
+    _context = multiprocessing
+
+# The index being matched. This is set in the parent process right before the
+# pool is created, so that workers inherit it instead of receiving it with
+# every query.
+_index = None
+
+# How long we wait for the workers, in seconds. After that, we assume that
+# something went wrong with them and match in the main process instead.
+TIMEOUT = 30
+
+
+def _init_worker():
+    # Every worker handles its own share of the features, don't let OpenCV
+    # spawn threads on top of that.
+    cv2.setNumThreads(1)
+
+    # Workers are forked before the main process installs its signal
+    # handlers, and the default action of SIGUSR1 is to terminate the
+    # process: a signal sent to the whole process group would kill them.
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+
+def _good_matches(args):
+    (start, end, scene_features, candidates) = args
+    return _index.find_good_matches(start, end, scene_features, candidates)
+
+
+#
+# This class spreads the matching of the stacked features of a DescriptorIndex
+# over a pool of worker processes, each of them handling a contiguous range of
+# rows. Only the features of the scene are sent to workers for every query,
+# and only the good matches come back: the pool is forked after the index is
+# built, so workers share the index (and the memory-mapped features of the
+# ItemStore) with the main process.
+#
+# The pool is forked once, by start(), which must be called before any other
+# thread is started: forking a process with several threads can deadlock the
+# children on locks that other threads held, e.g. the locks of logging
+# handlers. Workers only know about the rows of the index at that time, the
+# rows of the items registered later are matched by the main process, while
+# workers match theirs.
+#
+class MatchingExecutor(object):
+    def __init__(self, workers):
+        self.logger = logging.getLogger(__name__)
+        self.workers = workers
+        self.pool = None
+
+        # Number of rows and items of the index that workers know about.
+        self.rows = 0
+        self.items = 0
+
+    # Start the pool of workers for the specified index.
+    def start(self, index):
+        self.shutdown()
+
+        global _index
+        _index = index
+        self.rows = len(index.features) if index.features is not None else 0
+        self.items = len(index.items)
+        self.pool = _context.Pool(self.workers, initializer=_init_worker)
+
+        self.logger.debug("Started %s matching workers for %s items.",
+                          self.workers, len(index.items))
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    # Returns the good matches of the items of the index with the features of
+    # the scene, see DescriptorIndex.find_good_matches(). If `candidates` is
+    # specified, only these items are matched.
+    def good_matches(self, index, scene_features, candidates=None):
+        assert index is _index and self.pool is not None
+
+        # Workers don't know about the items registered after they were
+        # forked.
+        known_candidates = candidates
+        if candidates is not None:
+            known_candidates = candidates[candidates < self.items]
+
+        bounds = np.linspace(0, self.rows, self.workers + 1)
+        bounds = bounds.astype(np.intp)
+        tasks = [(bounds[i], bounds[i + 1], scene_features, known_candidates)
+                 for i in range(self.workers) if bounds[i] < bounds[i + 1]]
+        pending = self.pool.map_async(_good_matches, tasks)
+
+        # Meanwhile, match the rows added since then.
+        results = [index.find_good_matches(self.rows, len(index.features),
+                                           scene_features, candidates)]
+        try:
+            results.extend(pending.get(TIMEOUT))
+        except multiprocessing.TimeoutError:
+            self.logger.error("Matching workers didn't answer within %ss, "
+                              "matching in the main process.", TIMEOUT)
+            results.append(index.find_good_matches(0, self.rows,
+                                                   scene_features,
+                                                   candidates))
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
@@ -0,0 +1,79 @@
+import cv2
+
+
+#
+# This class is a captured frame along with the mask of the object it
+# contains. The capture strategies used to return 4-channel BGRA images with
+# the mask as alpha channel, which meant splitting and merging full frames
+# every time we needed either part. Here, the BGR frame, the mask and the
+# grayscale version of the frame are kept as separate arrays, without copying
+# the frame.
+#
+# `mask` is None if the whole frame is relevant. The grayscale frame is
+# computed on first use, unless it is specified.
+#
+class ObjectFrame(object):
+    def __init__(self, frame, mask=None, grayscale=None):
+        self.frame = frame
+        self.mask = mask
+        self._grayscale = grayscale
+
+    # Returns `image` as an ObjectFrame. `image` can already be an
+    # ObjectFrame, a BGRA image with the mask as alpha channel, or a BGR
+    # image.
+    @staticmethod
+    def wrap(image):
+        if isinstance(image, ObjectFrame):
+            return image
+        if image.ndim == 3 and image.shape[2] == 4:
+            return ObjectFrame(image[:, :, :3], image[:, :, 3])
+        return ObjectFrame(image)
+
+    @property
+    def shape(self):
+        return self.frame.shape
+
+    @property
+    def grayscale(self):
+        if self._grayscale is None:
+            self._grayscale = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
+        return self._grayscale
+
+    # Returns the (x, y, width, height) bounding box of the mask, grown by
+    # `padding` pixels on every side and clipped to the frame. The box is
+    # empty if the mask is.
+    def bounding_box(self, padding=0):
+        (height, width) = self.frame.shape[:2]
+        if self.mask is None:
+            return (0, 0, width, height)
+
+        (x, y, w, h) = cv2.boundingRect(self.mask)
+        if w == 0 or h == 0:
+            return (0, 0, 0, 0)
+
+        left = max(0, x - padding)
+        top = max(0, y - padding)
+        right = min(width, x + w + padding)
+        bottom = min(height, y + h + padding)
+        return (left, top, right - left, bottom - top)
+
+    # Returns the grayscale frame and the mask, cropped to the specified
+    # (x, y, width, height) box. Only the box is converted to grayscale if
+    # the grayscale frame wasn't computed yet.
+    def crop(self, box):
+        (x, y, width, height) = box
+        roi = (slice(y, y + height), slice(x, x + width))
+        if self._grayscale is not None:
+            grayscale = self._grayscale[roi]
+        else:
+            grayscale = cv2.cvtColor(self.frame[roi], cv2.COLOR_BGR2GRAY)
+        mask = self.mask[roi] if self.mask is not None else None
+        return (grayscale, mask)
+
+    # Returns a BGRA image with the mask as alpha channel, e.g. to save the
+    # frame with transparency.
+    def to_bgra(self):
+        if self.mask is None:
+            return cv2.cvtColor(self.frame, cv2.COLOR_BGR2BGRA)
+        (blue, green, red) = cv2.split(self.frame)
+        return cv2.merge([blue, green, red, self.mask])